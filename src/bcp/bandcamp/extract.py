@@ -0,0 +1,105 @@
+from html.parser import HTMLParser
+
+
+class Page:
+    """Values extracted from a bandcamp page in a single pass"""
+
+    def __init__(self):
+        # og:* meta tags, property: content
+        self.meta = dict()
+        # `data-tralbum` attribute of the first script that has it
+        self.tralbum = None
+        # text of the h2 inside `#name-section`
+        self.name = None
+        # hrefs starting with /album/, in document order
+        self.albums_urls = list()
+        # hrefs of the anchors that contain a `span.track-title`
+        self.tracks_urls = list()
+        # text of the `span.time` inside `div.title`
+        self.tracks_times = list()
+
+
+class PageExtractor(HTMLParser):
+    """Collects into a `Page` only the values the items need, without
+    building a tree of the document like BeautifulSoup does.
+
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.page = Page()
+        self._in_name_section = False
+        self._name = None
+        self._href = None
+        self._href_added = False
+        # open divs since entering a `div.title`, 0 when outside
+        self._title_div_depth = 0
+        self._time = None
+
+    @classmethod
+    def extract(cls, html):
+        if isinstance(html, bytes):
+            html = html.decode("utf-8")
+        extractor = cls()
+        extractor.feed(html or "")
+        extractor.close()
+        return extractor.page
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get("class") or "").split()
+        href = attrs.get("href")
+        if href and href.startswith("/album/"):
+            self.page.albums_urls.append(href)
+
+        match tag:
+            case "meta":
+                prop = attrs.get("property")
+                if prop and prop.startswith("og:"):
+                    self.page.meta.setdefault(prop, attrs.get("content"))
+            case "script":
+                if self.page.tralbum is None and "data-tralbum" in attrs:
+                    self.page.tralbum = attrs["data-tralbum"]
+            case "a":
+                self._href = href
+                self._href_added = False
+            case "span":
+                if "track-title" in classes and self._href and not self._href_added:
+                    self.page.tracks_urls.append(self._href)
+                    self._href_added = True
+                if "time" in classes and self._title_div_depth:
+                    self._time = ""
+            case "div":
+                if self._title_div_depth:
+                    self._title_div_depth += 1
+                elif "title" in classes:
+                    self._title_div_depth = 1
+            case "h2":
+                if self._in_name_section and self.page.name is None:
+                    self._name = ""
+
+        if attrs.get("id") == "name-section":
+            self._in_name_section = True
+
+    def handle_endtag(self, tag):
+        match tag:
+            case "a":
+                self._href = None
+            case "span":
+                if self._time is not None:
+                    self.page.tracks_times.append(self._time.strip())
+                    self._time = None
+            case "div":
+                if self._title_div_depth:
+                    self._title_div_depth -= 1
+            case "h2":
+                if self._name is not None:
+                    self.page.name = self._name.strip()
+                    self._name = None
+                    self._in_name_section = False
+
+    def handle_data(self, data):
+        if self._name is not None:
+            self._name += data
+        if self._time is not None:
+            self._time += data
@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+
+from ..log import get_loger
+from ..utils import Storage
+
+_log = get_loger(__name__)
+
+
+class TracksIndex:
+    """The mp3s in the tracks directory with their size, last time they
+    were played and how many times, keyed by their path relative to
+    `root`, the same paths `Track.path` has.
+
+    Answers if a track is on disk without touching the filesystem. The
+    directory is scanned once when the index is loaded, so files
+    removed or added while the player wasn't running are noticed.
+
+    When the files take more than `max_bytes` the least recently
+    played ones are deleted, see `evict`.
+
+    """
+
+    def __init__(self, tracks_dir, max_bytes, path):
+        self.tracks_dir = tracks_dir
+        self.root = tracks_dir.parent
+        self.max_bytes = max_bytes
+        self.storage = Storage(None, path=path)
+        self._lock = threading.RLock()
+        self.entries = dict(self.storage.as_dict)
+        self.scan()
+
+    def key(self, path):
+        return str(path.relative_to(self.root))
+
+    def scan(self):
+        on_disk = dict()
+        for dirpath, _, filenames in os.walk(self.tracks_dir):
+            for filename in filenames:
+                if not filename.endswith(".mp3"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                on_disk[os.path.relpath(path, self.root)] = st
+        with self._lock:
+            entries = dict()
+            for key, st in on_disk.items():
+                entry = self.entries.get(key) or self.new_entry(st.st_mtime)
+                entry["size"] = st.st_size
+                entries[key] = entry
+            if entries != self.entries:
+                _log(f"tracks index: {len(entries)} tracks on disk")
+                self.entries = entries
+                self.storage.update(self.entries)
+
+    @classmethod
+    def new_entry(cls, last_played=None):
+        # tracks never played count as played when they were downloaded
+        return {
+            "size": 0,
+            "last_played": last_played or time.time(),
+            "play_count": 0,
+        }
+
+    def __contains__(self, path):
+        return self.key(path) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def size(self):
+        with self._lock:
+            return sum(entry["size"] for entry in self.entries.values())
+
+    def get_size(self, path):
+        entry = self.entries.get(self.key(path))
+        return entry["size"] if entry else 0
+
+    def add(self, path, size):
+        with self._lock:
+            entry = self.entries.setdefault(self.key(path), self.new_entry())
+            entry["size"] = size
+            self.storage.update(self.entries)
+
+    def played(self, path):
+        with self._lock:
+            entry = self.entries.get(self.key(path))
+            if entry is None:
+                return
+            entry["last_played"] = time.time()
+            entry["play_count"] += 1
+            self.storage.update(self.entries)
+
+    def evict(self, keep=()):
+        """delete the least recently played tracks until they fit in
+        `max_bytes`, except the paths in `keep`. returns the deleted
+        paths"""
+        keep = {self.key(path) for path in keep}
+        evicted = list()
+        with self._lock:
+            size = self.size
+            by_last_played = sorted(
+                self.entries.items(), key=lambda item: item[1]["last_played"]
+            )
+            for key, entry in by_last_played:
+                if size <= self.max_bytes:
+                    break
+                if key in keep:
+                    continue
+                path = self.root / key
+                try:
+                    path.unlink(missing_ok=True)
+                except OSError as e:
+                    _log(f"tracks index: can't delete {key} {e}")
+                    continue
+                del self.entries[key]
+                size -= entry["size"]
+                evicted.append(path)
+            if evicted:
+                _log(f"tracks index: evicted {len(evicted)} tracks")
+                self.storage.update(self.entries)
+        return evicted
@@ -6,6 +6,12 @@ REQUEST_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 class ItemBase:
     REQUEST_EXPIRE_HOURS = 24
+    # an expired page is requested with its ETag or Last-Modified and
+    # kept if the server says it didn't change
+    REVALIDATE = True
+    # set by the player, not read from the page. they are kept when the
+    # item is replaced by one loaded again, see `keep_local`
+    LOCAL_ATTRIBUTES = ()
 
     def update(self, content):
         for k, v in content.items():
@@ -22,18 +28,38 @@ class ItemBase:
             d[k] = v
         return d
 
-    def update_from_soup(self, soup):
+    def update_from_page(self, page):
+        self.touch()
+
+    def keep_local(self, previous):
+        """copies the local attributes from `previous`, the item or the
+        stored dict this item replaces"""
+        if previous is None:
+            return
+        content = previous if isinstance(previous, dict) else vars(previous)
+        for name in self.LOCAL_ATTRIBUTES:
+            if name in content:
+                setattr(self, name, content[name])
+
+    def touch(self):
         self.request_datetime = datetime.now().strftime(REQUEST_DATETIME_FORMAT)
 
     @property
     def download_url(self):
         return self.url
 
+    @property
+    def expires_at(self):
+        return datetime.strptime(
+            self.request_datetime, REQUEST_DATETIME_FORMAT
+        ) + timedelta(hours=self.REQUEST_EXPIRE_HOURS)
+
     @property
     def expired(self):
-        return datetime.now() - timedelta(
-            hours=self.REQUEST_EXPIRE_HOURS
-        ) > datetime.strptime(self.request_datetime, REQUEST_DATETIME_FORMAT)
+        return self.expires_soon(timedelta())
+
+    def expires_soon(self, margin):
+        return datetime.now() + margin > self.expires_at
 
 
 class ItemWithChildren:
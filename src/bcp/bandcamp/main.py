@@ -1,17 +1,25 @@
 from datetime import timedelta
 import json
-from http.client import IncompleteRead
+import os
+import shutil
+import threading
+import time
+from http.client import HTTPException, IncompleteRead
+from ssl import SSLError
 from urllib.error import HTTPError, URLError
-from urllib.parse import urlparse
+from urllib.parse import urljoin, urlparse
 
-from bs4 import BeautifulSoup
 from slugify import slugify
 
+from .extract import PageExtractor
+from .index import TracksIndex
 from .items import ItemBase, ItemWithChildren, ItemWithParent
 
 from ..log import get_loger
 from ..utils import (
+    AsyncRunner,
     HTTPSession,
+    RetryPolicy,
     StopCurrentTaskExeption,
     Storage,
     USER_DATA_DIR,
@@ -24,17 +32,30 @@ if not TRACKS_DIR.exists():
     TRACKS_DIR.mkdir(parents=True, exist_ok=True)
 _log("tracks path:", TRACKS_DIR)
 
+# tracks being downloaded, moved to TRACKS_DIR when complete
+PARTIAL_DIR = USER_DATA_DIR / "partial"
+
+# disk space for the tracks, the least recently played are deleted
+# when a download goes over it
+TRACKS_MAX_BYTES = int(os.environ.get("TRACKS_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+TRACKS_INDEX_PATH = USER_DATA_DIR / "tracks_index.json"
+
 band_type = "band"
 album_type = "album"
 track_type = "song"
 
 http_session = HTTPSession()
+async_runner = AsyncRunner()
+async_runner.start()
 
 
 class Track(ItemBase, ItemWithParent):
     of_type = "song"
     # Value determined through trial and error
     REQUEST_EXPIRE_HOURS = 1
+    # the page has the mp3 url, it expires even if the page didn't change
+    REVALIDATE = False
+    LOCAL_ATTRIBUTES = ("path", "cached", "loudness", "peak")
 
     def __init__(self, url):
         super().__init__()
@@ -44,27 +65,36 @@ class Track(ItemBase, ItemWithParent):
         self.album = self.parent
         self.cached = False
 
-    def update_from_soup(self, soup):
-        super().update_from_soup(soup)
-        script = soup.find("script", attrs={"data-tralbum": True})
+    def update_from_page(self, page):
         # happened only once, i wasn't able to reproduce
-        if not script:
+        if not page.tralbum:
             return
+        super().update_from_page(page)
 
-        data = json.loads(script["data-tralbum"])
-        self.url = data["url"]
-        self.of_type = soup.find("meta", property="og:type").get("content")
-        self.artist = data["artist"]
+        data = json.loads(page.tralbum)
+        self.of_type = page.meta["og:type"]
+        self.update_from_trackinfo(data["url"], data["artist"], data["trackinfo"][0])
+        return True
+
+    def update_from_trackinfo(self, url, artist, info):
+        """`info` is an entry of the `trackinfo` list found in the
+        `data-tralbum` of track and album pages"""
+        self.touch()
+        self.url = url
+        self.artist = artist
         # The album has a link to the track, but there's no MP3
         # available.  In this case, we skip the track. I haven't found
         # a way to skip listing this track when loading the album.
         self.mp3_url = None
-        if data["trackinfo"][0]["file"] is not None:
-            self.mp3_url = data["trackinfo"][0]["file"]["mp3-128"]
-        self.title = data["trackinfo"][0]["title"]
-        self.duration = data["trackinfo"][0]["duration"]
-        self.lyrics = data["trackinfo"][0]["lyrics"]
-        return True
+        if info["file"] is not None:
+            self.mp3_url = info["file"]["mp3-128"]
+        self.title = info["title"]
+        self.duration = info["duration"]
+        self.lyrics = info.get("lyrics")
+
+    @property
+    def loaded(self):
+        return hasattr(self, "title")
 
     def update_from_dict(self, content):
         super().update(content)
@@ -89,16 +119,39 @@ class Album(ItemBase, ItemWithChildren, ItemWithParent):
         self.add_track = self.add_children
         self.add_tracks = self.add_childrens
 
-    def update_from_soup(self, soup):
-        super().update_from_soup(soup)
-        self.name = soup.find(id="name-section").h2.text.strip()
-        self.of_type = soup.find("meta", property="og:type").get("content")
-        self.duration = self.get_album_duration(soup)
-        self.tracks_urls = self.get_tracks_urls(soup)
+    def update_from_page(self, page):
+        super().update_from_page(page)
+        self.name = page.name
+        self.of_type = page.meta["og:type"]
+        if self.update_from_tralbum(page):
+            return True
+        self.duration = self.get_album_duration(page)
+        self.tracks_urls = self.get_tracks_urls(page)
         for t_url in self.tracks_urls:
             self.add_track(self.children_class(t_url))
         return True
 
+    def update_from_tralbum(self, page):
+        """the album's `data-tralbum` has the information of all its
+        tracks, they are loaded from it so there's no need to request
+        each track page. returns False if it's not available."""
+        if not page.tralbum:
+            return False
+        data = json.loads(page.tralbum)
+        trackinfo = data.get("trackinfo") or []
+        if not trackinfo or not all(i.get("title_link") for i in trackinfo):
+            return False
+        self.tracks_urls = [i["title_link"] for i in trackinfo]
+        self.duration = str(
+            timedelta(seconds=int(sum(i.get("duration") or 0 for i in trackinfo)))
+        )
+        for info in trackinfo:
+            track = self.children_class(urljoin(self.url, info["title_link"]))
+            track.of_type = track_type
+            track.update_from_trackinfo(track.url, data["artist"], info)
+            self.add_track(track)
+        return True
+
     def update_from_dict(self, content):
         super().update(content)
         self.add_tracks(content["tracks_urls"])
@@ -107,31 +160,22 @@ class Album(ItemBase, ItemWithChildren, ItemWithParent):
         return self.tracks_urls[index]
 
     @classmethod
-    def get_tracks_urls(cls, soup):
+    def get_tracks_urls(cls, page):
         """there's no way to know if the track can be played from the
         album page's html so we return track urls that lead to a track
         page that has no mp3 file. if the track can be played will be
         validated when loading the track.
 
         """
-
-        def is_track(tag):
-            if tag.name == "a" and tag.find("span", attrs={"class": "track-title"}):
-                return tag
-
-        return [i["href"] for i in soup.find_all(is_track)]
+        return list(page.tracks_urls)
 
     @classmethod
-    def get_album_duration(cls, soup):
+    def get_album_duration(cls, page):
         def in_seconds(time_string):
             m, s = time_string.split(":")
             return int(m) * 60 + int(s)
 
-        d = 0
-        for div in soup.find_all("div", "title"):
-            t = div.find("span", "time")
-            if t:
-                d += in_seconds(t.text.strip())
+        d = sum(in_seconds(t) for t in page.tracks_times if t)
         return str(timedelta(seconds=d))
 
     @property
@@ -160,14 +204,14 @@ class Band(ItemBase, ItemWithChildren):
         self.add_album = self.add_children
         self.add_albums = self.add_childrens
 
-    def update_from_soup(self, soup):
-        super().update_from_soup(soup)
-        self.name = soup.find("meta", property="og:title").get("content")
-        self.of_type = soup.find("meta", property="og:type").get("content")
-        self.url = soup.find("meta", property="og:url").get("content")
-        self.description = soup.find("meta", property="og:description").get("content")
+    def update_from_page(self, page):
+        super().update_from_page(page)
+        self.name = page.meta["og:title"]
+        self.of_type = page.meta["og:type"]
+        self.url = page.meta["og:url"]
+        self.description = page.meta["og:description"]
         # already set if loaded form storage
-        self.albums_urls = self.get_albums_urls(soup)
+        self.albums_urls = self.get_albums_urls(page)
         for a_url in self.albums_urls:
             self.add_album(Album(a_url))
         return True
@@ -181,16 +225,11 @@ class Band(ItemBase, ItemWithChildren):
         return self.albums_urls[index]
 
     @classmethod
-    def get_albums_urls(cls, soup):
-        """extract from html and returns relative albums urls"""
-
+    def get_albums_urls(cls, page):
+        """returns relative albums urls"""
         # bandcamp.com now includes tracks in the band page, before it
-        # was only albums, so we have to filter them out.
-        def is_album(href):
-            return href and href.startswith("/album/")
-
-        r = [i["href"] for i in soup.find_all(href=is_album)]
-        return r
+        # was only albums, so the extractor filters them out.
+        return list(page.albums_urls)
 
     def to_dict(self):
         d = super().to_dict()
@@ -225,6 +264,34 @@ class BandCamp:
     DOMAIN_NAME = "bandcamp.com"
     BASE_URL = f"https://{DOMAIN_NAME}"
     DOMAIN_CDN = "bcbits.com"
+    http_session = http_session
+    DOWNLOAD_CHUNK_SIZE = 64 * 1024
+    # mp3s come from the cdn, they can be retried more and sooner
+    RETRY_POLICIES = {
+        "page": RetryPolicy(retries=3, backoff=2),
+        "mp3": RetryPolicy(retries=5, backoff=1),
+    }
+    # a connection dropped while streaming the body raises one of the
+    # OSErrors from `read1`, the next attempt resumes the partial file
+    RETRY_EXCEPTIONS = (
+        HTTPException,
+        URLError,
+        ConnectionError,
+        TimeoutError,
+        SSLError,
+    )
+    # path: (bytes done, bytes total) of the files being downloaded,
+    # total is None when the server doesn't send the length
+    downloads = dict()
+    # path: lock, so the player and the prefetcher don't download the
+    # same file at the same time
+    _download_locks = dict()
+    _download_locks_lock = threading.Lock()
+    # partial files being played. they are copied to the tracks
+    # directory when complete instead of renamed, an open file can't
+    # be renamed on windows
+    open_partials = set()
+    _partials_lock = threading.Lock()
 
     @classmethod
     def items_serializer(_, obj):
@@ -237,32 +304,28 @@ class BandCamp:
     def __init__(self):
         super().__init__()
         self.storage = Storage(self.items_serializer)
-        self.items = dict()
-        for k, v in self.storage.as_dict.items():
+        # values are the stored dicts until the item is first requested,
+        # then they are replaced by the hydrated `Band`, `Album` or
+        # `Track`. both kinds are serialized when storage is updated.
+        self.items = dict(self.storage.as_dict)
+        _log(f"bandcamp items in storage: {len(self.items)}")
+        self.tracks_index = TracksIndex(TRACKS_DIR, TRACKS_MAX_BYTES, TRACKS_INDEX_PATH)
+        _log(f"tracks on disk: {len(self.tracks_index)}")
+        self.clean_partials()
+
+    def get_item(self, url):
+        """returns the item for `url` building it from the stored
+        content the first time it's requested"""
+        item = self.items.get(url)
+        if isinstance(item, dict):
             try:
-                item = self.load_item(k, v)
+                item = self.load_item(url, item)
             except ValueError as e:
-                _log("bandcamp __init__", e)
-            else:
-                self.items[k] = item
-        for band in self.get_bands():
-            for a_url in band.albums_urls:
-                a = Album(self.to_full_url(band, a_url))
-                ac = self.storage.as_dict.get(a_url)
-                if ac is None:
-                    continue
-                a.update(ac)
-                band.add_album(a)
-                a.band = band
-        for album in self.get_albums():
-            for t_url in album.tracks_urls:
-                t = Track(self.to_full_url(band, t_url))
-                tc = self.storage.as_dict.get(t_url)
-                if tc is None:
-                    continue
-                t.update(tc)
-                album.add_track(t)
-                t.album = album
+                _log("bandcamp get_item", e)
+                del self.items[url]
+                return None
+            self.items[url] = item
+        return item
 
     def load_item(self, url, content):
         """called when loading items from storage. returns an instance
@@ -283,30 +346,87 @@ class BandCamp:
         item.update_from_dict(content)
         return item
 
+    def get_items_of_type(self, of_type):
+        urls = [
+            k
+            for k, v in self.items.items()
+            if (v["of_type"] if isinstance(v, dict) else v.of_type) == of_type
+        ]
+        return [i for i in map(self.get_item, urls) if i is not None]
+
+    def get_unanalyzed_track(self):
+        """returns a downloaded track that has no loudness values yet"""
+        for url, item in list(self.items.items()):
+            content = item if isinstance(item, dict) else vars(item)
+            if content.get("of_type", Track.of_type) != Track.of_type:
+                continue
+            if "loudness" in content or not content.get("path"):
+                continue
+            if self.is_downloaded(self.get_absolute_path(content["path"])):
+                return self.get_item(url)
+
+    def is_downloaded(self, path):
+        return path in self.tracks_index
+
+    def track_played(self, track):
+        self.tracks_index.played(self.get_absolute_path(track.path))
+
     def get_bands(self):
-        return [i for i in self.items.values() if i.of_type == Band.of_type]
+        return self.get_items_of_type(Band.of_type)
 
     def get_albums(self):
-        return [i for i in self.items.values() if i.of_type == Album.of_type]
+        return self.get_items_of_type(Album.of_type)
+
+    # the synchronous methods wait for their async versions, which run
+    # in `async_runner`'s event loop. cancelling `scope`, a `CancelScope`,
+    # stops waiting for them and for the retries of their requests
+
+    def get_band(self, url, scope=None):
+        return async_runner.run_sync(self.get_band_async(url, scope), scope)
 
-    def get_band(self, url):
-        band = self.items.get(url)
+    def get_album(self, url, scope=None):
+        return async_runner.run_sync(self.get_album_async(url, scope), scope)
+
+    def get_track(self, url, scope=None):
+        return async_runner.run_sync(self.get_track_async(url, scope), scope)
+
+    def download_mp3(self, track, scope=None):
+        return async_runner.run_sync(self.download_mp3_async(track, scope), scope)
+
+    async def get_band_async(self, url, scope=None):
+        band = self.get_item(url)
         if band is not None and not band.expired:
             return band
-        return self.update_item(Band(url))
+        return await self.update_item_async(Band(url), band, scope)
 
-    def get_album(self, url):
-        album = self.items.get(url)
+    async def get_album_async(self, url, scope=None):
+        album = self.get_item(url)
         if album is not None and not album.expired:
             return album
-        return self.update_item(Album(url))
+        return await self.update_item_async(Album(url), album, scope)
 
-    def get_track(self, url):
-        track = self.items.get(url)
+    async def get_track_async(self, url, scope=None):
+        track = self.get_item(url)
         if track is not None and (not track.expired or track.cached):
             return track
-        item = self.update_item(Track(url))
-        return item
+        return await self.update_item_async(Track(url), track, scope)
+
+    async def update_item_async(self, item, current=None, scope=None):
+        """waits for the rate limiter in the event loop, then does the
+        blocking request and parsing in the http session's pool"""
+        await http_session.throttle_async(item.download_url)
+        return await http_session.run_blocking(
+            self.update_item, item, current, throttle=False, scope=scope
+        )
+
+    async def download_mp3_async(self, track, scope=None):
+        path = self.get_absolute_path(track.path)
+        if self.is_downloaded(path):
+            return True
+        await http_session.throttle_async(track.mp3_url)
+        return await http_session.run_blocking(
+            self.download_mp3_blocking, track, throttle=False, scope=scope
+        )
 
     def get_mp3_path(self, track):
         path = self.build_track_path_name(track)
@@ -323,67 +443,323 @@ class BandCamp:
         path = Path(TRACKS_DIR.name) / band / album / f"{slugify(track.title)}.mp3"
         return path
 
-    def update_item(self, item):
-        """item needs to be updated by downloading its content again"""
-        http_session.cache.invalidate(item.url)
-        success = item.update_from_soup(self.get_soup(item.download_url))
+    def update_item(self, item, current=None, throttle=True, scope=None):
+        """item needs to be updated by downloading its content again.
+        the request is conditional, if the server says the page didn't
+        change the `current` item is kept and only its request time is
+        updated. items that can't be revalidated are always requested"""
+        if not item.REVALIDATE:
+            http_session.cache.invalidate(item.download_url)
+        html, not_modified = self.fetch_content(
+            item.download_url,
+            item.REQUEST_EXPIRE_HOURS,
+            revalidate=True,
+            throttle=throttle,
+            scope=scope,
+        )
+        if not_modified and current is not None:
+            _log(f"not modified {current.url}")
+            current.touch()
+            self.storage.update(self.items)
+            return current
+        success = item.update_from_page(PageExtractor.extract(html))
         if not success:
             return
+        item.keep_local(current if current is not None else self.items.get(item.url))
         self.items[item.url] = item
+        if item.of_type == Album.of_type:
+            # tracks loaded from the album page don't need a request
+            for track in item.tracks:
+                if track.loaded:
+                    track.keep_local(self.items.get(track.url))
+                    self.items[track.url] = track
         self.storage.update(self.items)
         return item
 
     @classmethod
-    def get_soup(cls, url):
-        html = cls.download_content(url)
-        return BeautifulSoup(html, "html.parser")
-
-    @classmethod
-    def download_content(cls, url):
+    def fetch_content(
+        cls,
+        url,
+        expire_hours=None,
+        path=None,
+        revalidate=False,
+        throttle=True,
+        retry="page",
+        scope=None,
+    ):
+        """returns a tuple with the content of `url` and if it was
+        revalidated with the server (a 304). if `path` is given the
+        content is streamed to that file instead and the path returned.
+        `throttle=False` skips the rate limiter on the first attempt.
+        `retry` is the key of the `RETRY_POLICIES` to use. the waits
+        between attempts end early, without content, when `scope` is
+        cancelled"""
         content = None
-        attempt, retries = (1, 3)
-        while attempt <= retries:
-            _log(f"download_content attempt: {attempt}")
+        not_modified = False
+        policy = cls.RETRY_POLICIES[retry]
+        attempt = 1
+        while attempt <= policy.retries:
+            _log(f"fetch_content attempt: {attempt}")
+            retry_after = None
+            headers = None
+            if path is not None and (offset := cls.get_partial_offset(path)):
+                _log(f"    resuming from {offset}")
+                headers = {"Range": f"bytes={offset}-"}
             try:
-                with http_session.get(url) as response:
+                with http_session.get(
+                    url, expire_hours, revalidate, throttle, headers
+                ) as response:
                     new_url = response.geturl()
                     if url != new_url:
                         # we don't know in which cases bandcamp redirecs so we
                         # don't know what to do in case it happens
                         _log(f"The requested url {url} redirected to {new_url}")
                         break
-                    content = response.read()
+                    not_modified = getattr(response, "not_modified", False)
+                    if path is None:
+                        content = response.read()
+                    else:
+                        content = cls.stream_to_file(response, path)
                     break
             except HTTPError as e:
-                _log(f"    download_content {e}")
+                _log(f"    fetch_content {e}")
                 code = e.file.code
                 if code == 410:
                     _log("    link expired")
                     raise LinkExpiredException
-                if 400 <= code < 500:
+                if code == 416 and headers:
+                    # the partial file doesn't match, start again
+                    cls.discard_partial(path)
+                elif 400 <= code < 500 and code != 429:
                     break
-                _log("        retrying")
-            except (IncompleteRead, URLError, TimeoutError) as e:
+                elif code in (429, 503):
+                    retry_after = e.headers.get("Retry-After")
+            except cls.RETRY_EXCEPTIONS as e:
                 _log(f"    retrying for: {e}")
-                attempt += 1
+            if attempt < policy.retries:
+                delay = policy.delay(attempt, retry_after)
+                _log(f"        retrying in {delay:.2f}")
+                if scope is None:
+                    time.sleep(delay)
+                elif scope.sleep(delay):
+                    _log("    cancelled")
+                    break
+            attempt += 1
+            # retries are always throttled
+            throttle = True
         else:
             _log("    Problem reaching server")
-        return content
+        return content, not_modified
+
+    def refresh_track(self, track, scope=None):
+        """request the track page again to get a new mp3 url, the
+        track is updated in place so whoever holds it sees the new
+        url"""
+        _log(f"refresh track {track.url}")
+        # a 304 would keep the page with the expired url
+        http_session.cache.invalidate(track.download_url)
+        html, _ = self.fetch_content(
+            track.download_url,
+            track.REQUEST_EXPIRE_HOURS,
+            revalidate=True,
+            scope=scope,
+        )
+        if not track.update_from_page(PageExtractor.extract(html)):
+            raise StopCurrentTaskExeption("refresh_track: cant get track")
+        self.items[track.url] = track
+        self.storage.update(self.items)
+        return track
 
-    @classmethod
-    def download_mp3(cls, track):
+    def download_mp3_blocking(self, track, throttle=True, scope=None):
         cached = True
-        path = cls.get_absolute_path(track.path)
-        if not path.exists():
-            cached = False
-            with http_session.cache.disable():
-                content = cls.download_content(track.mp3_url)
-            if content is None:
-                raise StopCurrentTaskExeption("download_mp3: cant get mp3")
-            with open(path, "bw") as song_file:
-                song_file.write(content)
+        path = self.get_absolute_path(track.path)
+        with self._download_locks_lock:
+            lock = self._download_locks.setdefault(path, threading.Lock())
+        with lock:
+            if not self.is_downloaded(path):
+                cached = False
+                with http_session.cache.disable():
+                    try:
+                        content, _ = self.fetch_content(
+                            track.mp3_url,
+                            path=path,
+                            throttle=throttle,
+                            retry="mp3",
+                            scope=scope,
+                        )
+                    except LinkExpiredException:
+                        # mp3 urls expire, get a new one and try again
+                        self.refresh_track(track, scope)
+                        content, _ = self.fetch_content(
+                            track.mp3_url, path=path, retry="mp3", scope=scope
+                        )
+                if content is None:
+                    raise StopCurrentTaskExeption("download_mp3: cant get mp3")
+                self.tracks_index.add(path, path.stat().st_size)
+                self.tracks_index.evict(keep=[path])
+        with self._download_locks_lock:
+            if not lock.locked():
+                self._download_locks.pop(path, None)
         return cached
 
+    @classmethod
+    def download_progress(cls, path):
+        return cls.downloads.get(path)
+
+    @classmethod
+    def stream_to_file(cls, response, path):
+        """write the response body in chunks to a partial file in
+        `PARTIAL_DIR` and move it to `path` when complete, so a partial
+        download is never taken for a cached track.
+
+        the expected length is saved next to the partial file, if the
+        download is interrupted the next one asks only for the missing
+        bytes with a `Range` header and this appends the 206 response.
+
+        """
+        tmp_path = cls.get_partial_path(path)
+        if response.status == 206:
+            done, total = cls.parse_content_range(response.headers)
+            if done != cls.get_partial_offset(path) or total is None:
+                cls.discard_partial(path)
+                raise IncompleteRead(b"")
+            mode = "ab"
+        else:
+            total = response.headers.get("Content-Length")
+            total = int(total) if total else None
+            done = 0
+            mode = "wb"
+        cls.downloads[path] = (done, total)
+        tmp_path.parent.mkdir(parents=True, exist_ok=True)
+        cls.get_partial_length_path(path).write_text(json.dumps({"total": total}))
+        try:
+            with open(tmp_path, mode) as song_file:
+                while chunk := response.read1(cls.DOWNLOAD_CHUNK_SIZE):
+                    song_file.write(chunk)
+                    done += len(chunk)
+                    cls.downloads[path] = (done, total)
+        except Exception:
+            if total is None:
+                # can't know where to resume
+                cls.discard_partial(path)
+            raise
+        finally:
+            cls.downloads.pop(path, None)
+        if total is None or done == total:
+            cls.promote_partial(path)
+        elif done > total:
+            cls.discard_partial(path)
+            raise IncompleteRead(b"")
+        else:
+            raise IncompleteRead(b"", total - done)
+        return path
+
+    @classmethod
+    def parse_content_range(cls, headers):
+        """returns the first byte and total length of `bytes a-b/total`"""
+        try:
+            _, byte_range = headers.get("Content-Range", "").split(" ")
+            first_last, total = byte_range.split("/")
+            first = int(first_last.split("-")[0])
+            return first, None if total == "*" else int(total)
+        except ValueError:
+            return None, None
+
+    @classmethod
+    def get_partial_path(cls, path):
+        return PARTIAL_DIR / path.relative_to(TRACKS_DIR)
+
+    @classmethod
+    def get_partial_length_path(cls, path):
+        partial_path = cls.get_partial_path(path)
+        return partial_path.with_name(partial_path.name + ".json")
+
+    @classmethod
+    def get_partial_offset(cls, path):
+        """bytes already downloaded of `path`, 0 if there's no partial
+        file or it can't be resumed"""
+        partial_path = cls.get_partial_path(path)
+        length_path = cls.get_partial_length_path(path)
+        if not (partial_path.exists() and length_path.exists()):
+            return 0
+        try:
+            total = json.loads(length_path.read_text())["total"]
+        except (ValueError, KeyError):
+            total = None
+        size = partial_path.stat().st_size
+        if total is None or size >= total:
+            cls.discard_partial(path)
+            return 0
+        return size
+
+    @classmethod
+    def promote_partial(cls, path):
+        """move the complete partial file of `path` in place. if it's
+        being played it's copied, `release_partial` removes it when
+        playback ends"""
+        partial_path = cls.get_partial_path(path)
+        with cls._partials_lock:
+            copy = partial_path in cls.open_partials
+            if not copy:
+                try:
+                    os.replace(partial_path, path)
+                except PermissionError:
+                    # a released sound can keep it open until collected
+                    copy = True
+            if copy:
+                tmp_path = path.with_name(path.name + ".tmp")
+                shutil.copyfile(partial_path, tmp_path)
+                os.replace(tmp_path, path)
+            cls.get_partial_length_path(path).unlink()
+
+    @classmethod
+    def open_partial(cls, path):
+        """returns the partial file of `path` marked as being played, or
+        None if the download already completed"""
+        partial_path = cls.get_partial_path(path)
+        with cls._partials_lock:
+            if not partial_path.exists():
+                return None
+            cls.open_partials.add(partial_path)
+        return partial_path
+
+    @classmethod
+    def release_partial(cls, partial_path):
+        """called when the player is done with `partial_path`. removes it
+        if it was already copied to the tracks directory, otherwise the
+        download renames it when it completes, or resumes from it"""
+        with cls._partials_lock:
+            if partial_path not in cls.open_partials:
+                return
+            cls.open_partials.discard(partial_path)
+            length_path = partial_path.with_name(partial_path.name + ".json")
+            if length_path.exists():
+                return
+            try:
+                partial_path.unlink(missing_ok=True)
+            except OSError as e:
+                # still open, `clean_partials` removes it next time
+                _log(f"can't remove partial {partial_path.name} {e}")
+
+    @classmethod
+    def clean_partials(cls):
+        """remove the partial files that can't be resumed, the ones left
+        after being copied to the tracks directory"""
+        for dirpath, _, filenames in os.walk(PARTIAL_DIR):
+            for filename in filenames:
+                if filename.endswith(".json") or filename + ".json" in filenames:
+                    continue
+                try:
+                    os.unlink(os.path.join(dirpath, filename))
+                except OSError as e:
+                    _log(f"can't remove partial {filename} {e}")
+
+    @classmethod
+    def discard_partial(cls, path):
+        _log(f"    discard partial {path.name}")
+        for p in (cls.get_partial_path(path), cls.get_partial_length_path(path)):
+            p.unlink(missing_ok=True)
+
     @classmethod
     def get_absolute_path(self, part):
         return USER_DATA_DIR / part
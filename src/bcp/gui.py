@@ -423,6 +423,7 @@ class MyView(arcade.View):
             (
                 self.player.statistics(),
                 self.player.info()["status"],
+                self.player.info()["download"],
                 self.player.info()["error"],
             )
         )
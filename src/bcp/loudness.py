@@ -0,0 +1,115 @@
+import math
+import operator
+import sys
+import time
+from array import array
+
+from arcade import load_sound
+
+# levels in dB. blocks under the absolute gate are silence, the ones
+# under the relative gate don't count for the integrated loudness
+ABSOLUTE_GATE = -70
+RELATIVE_GATE = -10
+BLOCK_SECONDS = 0.4
+SAMPLE_MAX = 32768
+# blocks are measured on one of every DECIMATION frames, the loudness
+# barely changes and it's that many times faster. the peak can be a bit
+# lower than the real one
+DECIMATION = 8
+# seconds to sleep after decoding each block, analysis runs in the
+# background and lets the gui and the player threads have the gil
+BLOCK_PAUSE = 0.005
+
+
+def analyze(path):
+    """returns a dict with the integrated `loudness` in LUFS and the
+    sample `peak` in dBFS of the mp3 at `path`, decoding it a block at
+    a time. values are None for silent files, the result is None if
+    the decoder doesn't produce 16 bit samples"""
+    source = load_sound(path, streaming=True).source
+    # the decoder keeps the file open until the source is deleted, it
+    # can't be evicted meanwhile on windows
+    try:
+        audio_format = source.audio_format
+        if audio_format is None or audio_format.sample_size != 16:
+            return None
+        block_bytes = int(audio_format.sample_rate * BLOCK_SECONDS) * 2
+        block_bytes *= audio_format.channels
+
+        def chunks():
+            while True:
+                audio = source.get_audio_data(block_bytes)
+                if audio is None:
+                    return
+                yield bytes(audio.data)[: audio.length]
+                time.sleep(BLOCK_PAUSE)
+
+        return measure(chunks(), audio_format.channels, block_bytes)
+    finally:
+        source.delete()
+
+
+def measure(chunks, channels, block_bytes):
+    """loudness and peak of 16 bit interleaved samples in `chunks`.
+
+    follows the gating of ITU-R BS.1770 on consecutive blocks but
+    without the K-weighting filter, too slow in pure python. good
+    enough to compare tracks with each other.
+
+    """
+    powers = list()
+    peak = 0
+    pending = b""
+    for chunk in chunks:
+        pending += chunk
+        while len(pending) >= block_bytes:
+            block, pending = pending[:block_bytes], pending[block_bytes:]
+            power, block_peak = measure_block(block, channels)
+            powers.append(power)
+            peak = max(peak, block_peak)
+    if pending:
+        power, block_peak = measure_block(pending, channels)
+        powers.append(power)
+        peak = max(peak, block_peak)
+
+    return {
+        "loudness": integrated_loudness(powers),
+        "peak": 20 * math.log10(peak / SAMPLE_MAX) if peak else None,
+    }
+
+
+def measure_block(block, channels, decimation=DECIMATION):
+    """returns the summed mean square of the channels, relative to full
+    scale, and the highest absolute sample, out of one of every
+    `decimation` frames"""
+    samples = array("h", block[: len(block) - len(block) % (2 * channels)])
+    if sys.byteorder == "big":
+        samples.byteswap()
+    if not samples:
+        return 0.0, 0
+    power = 0.0
+    peak = 0
+    step = channels * decimation
+    for channel in range(channels):
+        values = samples[channel::step]
+        power += sum_of_squares(values) / len(values)
+        peak = max(peak, max(values), -min(values))
+    return power / SAMPLE_MAX**2, peak
+
+
+def sum_of_squares(values):
+    if hasattr(math, "sumprod"):  # python 3.12, done in c
+        return math.sumprod(values, values)
+    return sum(map(operator.mul, values, values))
+
+
+def integrated_loudness(powers):
+    def loudness(power):
+        return -0.691 + 10 * math.log10(power)
+
+    gated = [p for p in powers if p > 0 and loudness(p) > ABSOLUTE_GATE]
+    if not gated:
+        return None
+    threshold = loudness(sum(gated) / len(gated)) + RELATIVE_GATE
+    gated = [p for p in gated if loudness(p) > threshold]
+    return loudness(sum(gated) / len(gated))
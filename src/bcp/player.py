@@ -1,32 +1,245 @@
+import math
+import os
+import threading
 import time
+from collections import OrderedDict
+from datetime import timedelta
 
-from arcade import load_sound
+from arcade import load_sound, schedule, unschedule
 
 from .bandcamp import (
     BandCamp,
+    async_runner,
     EndOfPlaylistException,
     LinkExpiredException,
 )
 from .log import get_loger
+from .loudness import analyze
 from .utils import BackgroundTaskRunner, StopCurrentTaskExeption
 
 _log = get_loger(__name__)
 
 
+class Fade:
+    """A linear volume ramp of a media player, evaluated by
+    `Player.update_fades` on each clock tick"""
+
+    def __init__(self, sound, media_player, start, end, duration, on_done=None):
+        self.sound = sound
+        self.media_player = media_player
+        self.start = start
+        self.end = end
+        self.duration = duration
+        self.on_done = on_done
+        self.start_time = time.monotonic()
+
+    def volume(self, now):
+        """returns the volume at `now` and if the fade is complete"""
+        if self.duration <= 0:
+            return self.end, True
+        progress = min(1.0, (now - self.start_time) / self.duration)
+        return self.start + (self.end - self.start) * progress, progress >= 1.0
+
+
+class UpcomingTrack:
+    """The track that follows the current one, with its sound already
+    opened so the transition doesn't wait for the decoder"""
+
+    def __init__(self, album, album_index, track, track_index, sound):
+        self.album = album
+        self.album_index = album_index
+        self.track = track
+        self.track_index = track_index
+        self.sound = sound
+
+
+class SoundPool:
+    """Sounds opened ahead of time for the paths about to be played.
+    streaming sounds can be played once, `take` removes them from the
+    pool. the memory bound uses the size of the file as the cost of an
+    entry. sounds evicted from the pool have their decoder closed"""
+
+    def __init__(self, max_sounds, max_bytes):
+        self.max_sounds = max_sounds
+        self.max_bytes = max_bytes
+        # path: (sound, size), in the order they'll be played
+        self.sounds = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return sum(size for _, size in self.sounds.values())
+
+    def warm(self, paths, skip=()):
+        """open the sounds of `paths` that exist, in order, until a
+        bound is reached. entries for other paths are evicted. `skip`
+        are paths already opened somewhere else"""
+        paths = [str(path) for path in paths[: self.max_sounds]]
+        skip = {str(path) for path in skip}
+        with self._lock:
+            evicted = [
+                self.sounds.pop(path)[0]
+                for path in list(self.sounds)
+                if path not in paths or path in skip
+            ]
+        for sound in evicted:
+            self.close(sound)
+        for path in paths:
+            if path in skip:
+                continue
+            with self._lock:
+                if path in self.sounds:
+                    continue
+                if len(self.sounds) >= self.max_sounds:
+                    return
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            if self.size + size > self.max_bytes:
+                return
+            try:
+                sound = load_sound(path, streaming=True)
+            except Exception as e:
+                # removed or can't be decoded
+                _log("sound pool: ", path, e)
+                continue
+            self.add(path, sound, size)
+
+    def put(self, path, sound, size=None):
+        """return a sound that wasn't played, it goes first, as the next
+        one to play. entries at the end are evicted to keep the bounds"""
+        if size is None:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                self.close(sound)
+                return
+        self.add(path, sound, size, first=True)
+
+    def add(self, path, sound, size, first=False):
+        path = str(path)
+        with self._lock:
+            previous = self.sounds.pop(path, None)
+            self.sounds[path] = (sound, size)
+            if first:
+                self.sounds.move_to_end(path, last=False)
+            evicted = [previous[0]] if previous else []
+            while self.sounds and (
+                len(self.sounds) > self.max_sounds or self.size > self.max_bytes
+            ):
+                evicted.append(self.sounds.popitem()[1][0])
+        for old in evicted:
+            self.close(old)
+
+    def take(self, path):
+        with self._lock:
+            sound, _ = self.sounds.pop(str(path), (None, None))
+        return sound
+
+    def clear(self):
+        with self._lock:
+            evicted = [sound for sound, _ in self.sounds.values()]
+            self.sounds.clear()
+        for sound in evicted:
+            self.close(sound)
+
+    @classmethod
+    def close(cls, sound):
+        """release the decoder of a sound that won't be played"""
+        try:
+            sound.source.delete()
+        except Exception as e:
+            _log("Unable to close sound", e)
+
+
 class Player:
     VOLUME_DELTA = 0.1
     VOLUME_DELTA_SMALL = 0.01
+    # bytes of a track downloaded before starting to play it, ~16
+    # seconds at 128 kbps
+    PROGRESSIVE_BUFFER_BYTES = 256 * 1024
+    # and when, at the current download rate, the rest of the track
+    # arrives in this fraction of the time left to play it
+    PROGRESSIVE_RATE_MARGIN = 0.8
+    # upcoming tracks downloaded while the current one plays and the
+    # disk space they can use before being played
+    PREFETCH_TRACKS = 3
+    PREFETCH_MAX_BYTES = 64 * 1024 * 1024
+    # mp3 urls of upcoming tracks are requested again when they expire
+    # in less than the margin, checked every interval seconds
+    MP3_URL_REFRESH_MARGIN = timedelta(minutes=10)
+    MP3_URL_REFRESH_INTERVAL = 60
+    # seconds between fade updates
+    FADE_INTERVAL = 1 / 60
+    # seconds the end of a track overlaps the start of the next one, 0
+    # starts the next track gaplessly
+    CROSSFADE_SECONDS = 0
+    # seconds before the end of a track the next one starts in gapless
+    # mode, covers the clock granularity
+    GAPLESS_LEAD_SECONDS = 2 * FADE_INTERVAL
+    # sounds of upcoming downloaded tracks opened ahead of time and the
+    # size of their files
+    WARM_POOL_SOUNDS = 2
+    WARM_POOL_MAX_BYTES = 32 * 1024 * 1024
+    # tracks louder than the target are turned down to it. one track is
+    # analyzed every interval seconds
+    LOUDNESS_TARGET = -14
+    LOUDNESS_ANALYSIS_INTERVAL = 5
 
     task_runner = BackgroundTaskRunner()
+    prefetch_runner = BackgroundTaskRunner()
 
-    def __init__(self, handler_music_over, skip_cached=False):
+    def __init__(
+        self,
+        handler_music_over,
+        skip_cached=False,
+        progressive=True,
+        prefetch_tracks=PREFETCH_TRACKS,
+        prefetch_max_bytes=PREFETCH_MAX_BYTES,
+        crossfade=CROSSFADE_SECONDS,
+        warm_pool_sounds=WARM_POOL_SOUNDS,
+        warm_pool_max_bytes=WARM_POOL_MAX_BYTES,
+        normalize=True,
+    ):
         self.bandcamp = BandCamp()
         self.task_runner.start()
+        self.prefetch_runner.start()
+        self.prefetch_runner.every(
+            self.MP3_URL_REFRESH_INTERVAL, self.refresh_upcoming_mp3_urls
+        )
+        self.prefetch_runner.every(
+            self.LOUDNESS_ANALYSIS_INTERVAL, self.analyze_next_track
+        )
         self.status_text = "Ready"
         self._handler_music_over = handler_music_over
         self.skip_cached = skip_cached
+        self.progressive = progressive
+        self.prefetch_tracks = prefetch_tracks
+        self.prefetch_max_bytes = prefetch_max_bytes
+        self.crossfade = crossfade
+        # next track opened ahead of time by `prepare_next_track`
+        self.upcoming = None
+        self._upcoming_lock = threading.Lock()
+        # held while the current track and media player are switched,
+        # by the task runner and by the clock
+        self._state_lock = threading.RLock()
+        self.sound_pool = SoundPool(warm_pool_sounds, warm_pool_max_bytes)
+        self.normalize = normalize
+        # applied to the user volume for the current track
+        self.gain = 1.0
+        # url: size of the tracks downloaded by `prefetch` not played yet
+        self.prefetched = dict()
         self.is_setup = None
+        # state of the background download of the current track, a
+        # download left running by `next` doesn't change it
         self.downloading = False
+        self.downloading_path = None
+        self.download_error = None
+        self._download_lock = threading.Lock()
+        # (position, bytes needed, (time, bytes done)) while waiting for
+        # the download after playback caught up with it
+        self.buffering = None
         self.current_sound = None
         self.media_player = None
         self.band = None
@@ -34,15 +247,26 @@ class Player:
         self.album = None
         self.track_index = -1
         self.track = None
+        self.track_play_path = None
         self.user_volume = 100
         self.continue_playing = False
+        # media player: Fade, updated from the clock in the main thread
+        self.fades = dict()
+        self._fades_lock = threading.Lock()
+        schedule(self.update_fades, self.FADE_INTERVAL)
+        schedule(self.update_transition, self.FADE_INTERVAL)
+        schedule(self.update_buffering, self.FADE_INTERVAL)
 
-    @task_runner.task
+    # same priority as `play`, so a play requested after loading a band
+    # doesn't run before it
+    @task_runner.task(priority=BackgroundTaskRunner.PRIORITY_USER)
     def setup(self, url):
+        self.is_setup = False
         self.status_text = "Loading band"
         self.url = url
+        self.prefetched = dict()
         try:
-            self.band = self.bandcamp.get_band(url)
+            self.band = self.bandcamp.get_band(url, self.task_runner.scope)
         except ValueError as e:
             self.status_text = e
             raise StopCurrentTaskExeption(self.status_text)
@@ -58,8 +282,13 @@ class Player:
 
         self.is_setup = True
 
-    @task_runner.task
+    @task_runner.task(priority=BackgroundTaskRunner.PRIORITY_USER)
     def play(self):
+        if self.buffering is not None:
+            # `resume_buffered` starts playing
+            self.continue_playing = True
+            self.status_text = "Buffering"
+            return
         if not self.album:
             try:
                 self.get_next_album()
@@ -75,11 +304,15 @@ class Player:
                 self.track = None
                 self.play()
                 return
-            self.get_media_player(self.bandcamp.get_absolute_path(self.track.path))
+            self.gain = self.get_track_gain(self.track)
+            self.get_media_player(self.track_play_path)
+            self.bandcamp.track_played(self.track)
         self.media_player.play()
         self.fade_in(0.5)
         self.continue_playing = True
         self.status_text = "Playing"
+        self.prefetch()
+        self.prepare_next_track()
 
     def get_next_track(self):
         self.status_text = "Loading track"
@@ -91,7 +324,8 @@ class Player:
             raise StopCurrentTaskExeption("No more tracks in album")
         self.track_index = track_index
         track = self.bandcamp.get_track(
-            self.bandcamp.to_full_url(self.band, self.album.get_track_url(track_index))
+            self.bandcamp.to_full_url(self.band, self.album.get_track_url(track_index)),
+            self.task_runner.scope,
         )
         if track is None:
             self.next()
@@ -104,40 +338,493 @@ class Player:
         track.album = self.album
         track.path = str(self.bandcamp.get_mp3_path(track))
         try:
-            track.cached = self.bandcamp.download_mp3(track)
+            track.cached, self.track_play_path = self.download_track(track)
         except LinkExpiredException as e:
             self.status_text = e
             self.next()
-            return
+            raise StopCurrentTaskExeption("link expired")
+        if self.prefetched.pop(track.url, None) is not None:
+            # downloaded ahead of time, not by a previous session
+            track.cached = False
         self.track = track
         self.track_index = track_index
         self.status_text = "Ready to play"
 
+    def download_track(self, track):
+        """download the track's mp3 and return if it was cached and the
+        path to play. in progressive mode the download continues in the
+        background and the partial file is returned once
+        `buffered_enough` says playback won't catch up with it. if it
+        does anyway, `on_eos` waits for more data and resumes. the
+        partial file is copied to the tracks directory when complete,
+        the player removes it when done with it.
+
+        """
+        path = self.bandcamp.get_absolute_path(track.path)
+        progressive = self.progressive and not self.bandcamp.is_downloaded(path)
+        with self._download_lock:
+            self.downloading = progressive
+            self.downloading_path = path
+            self.download_error = None
+        if not progressive:
+            return self.bandcamp.download_mp3(track, self.task_runner.scope), path
+
+        errors = list()
+
+        def download():
+            try:
+                self.bandcamp.download_mp3(track)
+            except Exception as e:
+                _log(f"download: {track.url} {e}")
+                errors.append(e)
+            finally:
+                with self._download_lock:
+                    if self.downloading_path == path:
+                        self.downloading = False
+                        self.download_error = errors[0] if errors else None
+
+        thread = threading.Thread(target=download, daemon=True)
+        thread.start()
+        partial_path = self.bandcamp.get_partial_path(path)
+        started = None
+        while thread.is_alive():
+            if self.task_runner.scope.cancelled:
+                # the download goes on, the track may be played later
+                raise StopCurrentTaskExeption("cancelled")
+            progress = self.bandcamp.download_progress(path)
+            if progress is not None and partial_path.exists():
+                if started is None:
+                    started = time.monotonic(), progress[0]
+                if self.buffered_enough(track.duration, progress, started):
+                    break
+            time.sleep(0.05)
+        else:
+            if errors:
+                raise errors[0]
+            return False, path
+        _log(f"progressive play after {progress[0]} bytes")
+        partial_path = self.bandcamp.open_partial(path)
+        if partial_path is None:
+            # completed while we were checking
+            return False, path
+        return False, partial_path
+
+    def buffered_enough(self, duration, progress, started, needed=0):
+        """if a track of `duration` seconds can play while downloading.
+        `progress` is (bytes done, total), `started` is (time, bytes
+        done) when the rate started being measured and `needed` the
+        bytes before the position playback starts from"""
+        done, total = progress
+        if total is None or not duration:
+            # can't tell how long the rest takes, wait for all of it
+            return False
+        if done >= total:
+            return True
+        if done - needed < self.PROGRESSIVE_BUFFER_BYTES:
+            return False
+        start_time, start_done = started
+        elapsed = time.monotonic() - start_time
+        if elapsed <= 0 or done <= start_done:
+            return False
+        rate = (done - start_done) / elapsed
+        to_download = (total - done) / rate
+        to_play = duration * (total - needed) / total
+        return to_download < to_play * self.PROGRESSIVE_RATE_MARGIN
+
+    @property
+    def playing_partial(self):
+        return bool(
+            self.track
+            and self.track_play_path
+            and self.track_play_path != self.bandcamp.get_absolute_path(self.track.path)
+        )
+
+    def on_eos(self):
+        """the media player reached the end of its file. a partial file
+        ends early when playback catches up with the download, then
+        `update_buffering` waits for more data"""
+        if not (self.playing_partial and self.downloading):
+            self._handler_music_over()
+            return
+        progress = self.bandcamp.download_progress(self.downloading_path)
+        done, total = progress or (0, None)
+        position = self.get_position()
+        if total:
+            # the player's time isn't reliable at the end of the stream
+            position = self.track.duration * done / total
+        _log(f"buffering at {position:.1f}s")
+        with self._state_lock:
+            self.clear_media_player_and_current_sound(release=False)
+            self.buffering = (position, done, (time.monotonic(), done))
+            self.status_text = "Buffering"
+
+    def update_buffering(self, delta_time):
+        """runs on the clock, resumes the track when enough of it is
+        downloaded or the download ended"""
+        if self.buffering is None or self.track is None:
+            return
+        position, needed, started = self.buffering
+        progress = self.bandcamp.download_progress(self.downloading_path)
+        if self.downloading:
+            if progress is None or not self.buffered_enough(
+                self.track.duration, progress, started, needed
+            ):
+                return
+        self.buffering = None
+        path = self.bandcamp.get_absolute_path(self.track.path)
+        if not self.bandcamp.is_downloaded(path) and not self.downloading:
+            self.status_text = f"Download failed: {self.download_error}"
+            self._handler_music_over()
+            return
+        self.resume_buffered(position)
+
+    @task_runner.task(priority=BackgroundTaskRunner.PRIORITY_USER)
+    def resume_buffered(self, position):
+        if self.track is None or self.media_player:
+            # moved to another track meanwhile
+            return
+        path = self.bandcamp.get_absolute_path(self.track.path)
+        previous_path = self.track_play_path
+        self.track_play_path = self.bandcamp.open_partial(path) or path
+        if previous_path != self.track_play_path:
+            self.bandcamp.release_partial(previous_path)
+        self.get_media_player(self.track_play_path)
+        self.media_player.seek(position)
+        if self.continue_playing:
+            self.fade_in(0.5)
+            self.status_text = "Playing"
+        else:
+            self.media_player.pause()
+            self.status_text = "Paused"
+
+    @prefetch_runner.task(
+        priority=BackgroundTaskRunner.PRIORITY_BACKGROUND, supersede=True
+    )
+    def prefetch(self):
+        """download the next `prefetch_tracks` tracks of the band while
+        the current one plays, without exceeding `prefetch_max_bytes`
+        of tracks that were not played yet. tracks are fetched
+        concurrently in the bandcamp event loop."""
+        upcoming = self.get_upcoming_tracks(self.prefetch_tracks)
+        self.prune_prefetched(upcoming)
+        prefetch = [
+            self.prefetch_track(album, track_url) for album, track_url in upcoming
+        ]
+        for result in async_runner.gather(*prefetch, scope=self.prefetch_runner.scope):
+            if isinstance(result, Exception):
+                _log(f"prefetch: {result}")
+        # the next tracks may be on disk now
+        self.prepare_next_track()
+        self.warm_sounds()
+
+    async def prefetch_track(self, album, track_url):
+        try:
+            track = await self.bandcamp.get_track_async(
+                self.bandcamp.to_full_url(album.band, track_url)
+            )
+            if track is None or track.mp3_url is None:
+                return
+            track.album = album
+            track.path = str(self.bandcamp.get_mp3_path(track))
+            # checked right before downloading, downloads already in
+            # flight can go over the budget
+            if sum(self.prefetched.values()) >= self.prefetch_max_bytes:
+                _log("prefetch: disk budget reached")
+                return
+            cached = await self.bandcamp.download_mp3_async(track)
+        except (LinkExpiredException, StopCurrentTaskExeption) as e:
+            _log(f"prefetch: {track_url} {e}")
+            return
+        if not cached:
+            _log(f"prefetch: downloaded {track_url}")
+            path = self.bandcamp.get_absolute_path(track.path)
+            self.prefetched[track.url] = self.bandcamp.tracks_index.get_size(path)
+
+    def prune_prefetched(self, upcoming):
+        """forget the prefetched tracks that are not `upcoming` anymore,
+        skipped or deleted from disk, so they don't count against the
+        budget"""
+        urls = set()
+        for album, track_url in upcoming:
+            url = self.bandcamp.to_full_url(album.band, track_url)
+            urls.add(url)
+            track = self.bandcamp.get_item(url)
+            if track is not None:
+                urls.add(track.url)
+        prefetched = dict()
+        for url, size in list(self.prefetched.items()):
+            track = self.bandcamp.get_item(url)
+            if url not in urls or track is None:
+                continue
+            path = getattr(track, "path", None)
+            if path and self.bandcamp.is_downloaded(
+                self.bandcamp.get_absolute_path(path)
+            ):
+                prefetched[url] = size
+        self.prefetched = prefetched
+
+    def refresh_upcoming_mp3_urls(self):
+        """runs periodically in the prefetch runner, upcoming tracks that
+        are not downloaded get a new mp3 url before the current one
+        expires, so there's no need to request the track page when it's
+        time to play them"""
+        tracks = [self.track] if self.track else []
+        for album, track_url in self.get_upcoming_tracks(self.prefetch_tracks):
+            track = self.bandcamp.get_item(
+                self.bandcamp.to_full_url(album.band, track_url)
+            )
+            if track is not None and getattr(track, "mp3_url", None):
+                tracks.append(track)
+        for track in tracks:
+            path = getattr(track, "path", None)
+            if path and self.bandcamp.is_downloaded(
+                self.bandcamp.get_absolute_path(path)
+            ):
+                continue
+            if not track.expires_soon(self.MP3_URL_REFRESH_MARGIN):
+                continue
+            try:
+                self.bandcamp.refresh_track(track)
+            except (LinkExpiredException, StopCurrentTaskExeption) as e:
+                _log(f"refresh mp3 url: {track.url} {e}")
+
+    @prefetch_runner.task(
+        priority=BackgroundTaskRunner.PRIORITY_BACKGROUND, supersede=True
+    )
+    def warm_sounds(self):
+        """open the sounds of the upcoming tracks already on disk, the
+        ones the playlist moved past are evicted"""
+        paths = list()
+        for album, track_url in self.get_upcoming_tracks(self.sound_pool.max_sounds):
+            track = self.bandcamp.get_item(
+                self.bandcamp.to_full_url(album.band, track_url)
+            )
+            if track is None or getattr(track, "mp3_url", None) is None:
+                continue
+            track.album = album
+            paths.append(
+                self.bandcamp.get_absolute_path(self.bandcamp.get_mp3_path(track))
+            )
+        with self._upcoming_lock:
+            upcoming = self.upcoming
+        skip = list()
+        if upcoming is not None:
+            skip.append(self.bandcamp.get_absolute_path(upcoming.track.path))
+        self.sound_pool.warm(paths, skip)
+
+    @task_runner.task(priority=BackgroundTaskRunner.PRIORITY_BACKGROUND, supersede=True)
+    def prepare_next_track(self):
+        """open the sound of the track after the current one when it's
+        already on disk, so `update_transition` can start it without a
+        gap. only items already loaded are used, tracks that need a
+        request or are not downloaded are left to `next`. with
+        `skip_cached` only tracks downloaded by `prefetch` are played"""
+        current = self.track
+        if current is None:
+            return
+        upcoming = self.get_upcoming_tracks(1, fetch=False)
+        if not upcoming:
+            return
+        album, track_url = upcoming[0]
+        with self._upcoming_lock:
+            if self.upcoming and self.upcoming.track.url.endswith(track_url):
+                return
+        track = self.bandcamp.get_item(self.bandcamp.to_full_url(album.band, track_url))
+        if track is None or getattr(track, "mp3_url", None) is None:
+            return
+        if self.skip_cached and track.url not in self.prefetched:
+            return
+        track.album = album
+        track.path = str(self.bandcamp.get_mp3_path(track))
+        path = self.bandcamp.get_absolute_path(track.path)
+        if not self.bandcamp.is_downloaded(path):
+            return
+        sound = self.sound_pool.take(path)
+        if sound is None:
+            try:
+                sound = load_sound(path, streaming=True)
+            except Exception as e:
+                # removed or can't be decoded, `next` deals with it
+                _log("prepare next track: ", path, e)
+                return
+        if album is self.album:
+            album_index, track_index = self.album_index, self.track_index + 1
+        else:
+            album_index, track_index = self.album_index + 1, 0
+        replaced = None
+        with self._upcoming_lock:
+            if self.track is current:
+                replaced = self.upcoming
+                self.upcoming = UpcomingTrack(
+                    album, album_index, track, track_index, sound
+                )
+                sound = None
+        if replaced is not None:
+            SoundPool.close(replaced.sound)
+        if sound is not None:
+            # `next` was called meanwhile, it may be played soon
+            self.sound_pool.put(path, sound)
+            return
+        _log(f"prepared next track {track.title}")
+
+    def update_transition(self, delta_time):
+        """runs on the clock, starts the prepared track when the current
+        one is about to end, crossfading them when `crossfade` is set.
+        if `next`, `pause` or `stop` hold the state lock it's tried again
+        on the next tick"""
+        if not self._state_lock.acquire(blocking=False):
+            return
+        try:
+            self._update_transition()
+        finally:
+            self._state_lock.release()
+
+    def _update_transition(self):
+        if not (self.continue_playing and self.playing and self.upcoming):
+            return
+        if self.track is None:
+            return
+        if self.track_play_path != self.bandcamp.get_absolute_path(self.track.path):
+            # still playing a partial file, its length is not known
+            return
+        length = self.current_sound.get_length()
+        if not length:
+            return
+        remaining = length - self.get_position()
+        if remaining > max(self.crossfade, self.GAPLESS_LEAD_SECONDS):
+            return
+        with self._upcoming_lock:
+            upcoming, self.upcoming = self.upcoming, None
+        if upcoming is None:
+            return
+        self.start_upcoming_track(upcoming, max(remaining, 0))
+
+    def start_upcoming_track(self, upcoming, remaining):
+        sound, media_player = self.current_sound, self.media_player
+        try:
+            media_player.pop_handlers()
+        except Exception as e:
+            _log("Unable to pop handler", e)
+        self.gain = self.get_track_gain(upcoming.track)
+        volume = min(1.0, self.user_volume) * self.gain
+        if self.crossfade:
+            self.start_fade(
+                sound,
+                media_player,
+                0.0,
+                remaining,
+                on_done=lambda: sound.stop(media_player),
+                exact=True,
+            )
+            self.current_sound = upcoming.sound
+            self.media_player = upcoming.sound.play(volume=0)
+            self.start_fade(
+                self.current_sound,
+                self.media_player,
+                volume,
+                self.crossfade,
+                exact=True,
+            )
+        else:
+            media_player.push_handlers(on_eos=lambda: sound.stop(media_player))
+            self.current_sound = upcoming.sound
+            self.media_player = upcoming.sound.play(volume=volume)
+        self.media_player.push_handlers(on_eos=self.on_eos)
+
+        track = upcoming.track
+        track.cached = self.prefetched.pop(track.url, None) is None
+        self.album = upcoming.album
+        self.album_index = upcoming.album_index
+        self.track = track
+        self.track_index = upcoming.track_index
+        self.track_play_path = self.bandcamp.get_absolute_path(track.path)
+        self.bandcamp.track_played(track)
+        self.status_text = "Playing"
+        self.prefetch()
+        self.prepare_next_track()
+
+    def analyze_next_track(self):
+        """runs periodically in the prefetch runner, measures the
+        loudness of one downloaded track and stores it with the track"""
+        track = self.bandcamp.get_unanalyzed_track()
+        if track is None:
+            return
+        try:
+            result = analyze(str(self.bandcamp.get_absolute_path(track.path)))
+        except Exception as e:
+            _log(f"loudness: {track.url} {e}")
+            result = None
+        result = result or dict()
+        track.loudness = result.get("loudness")
+        track.peak = result.get("peak")
+        _log(f"loudness: {track.url} {track.loudness} LUFS")
+        self.bandcamp.storage.update(self.bandcamp.items)
+
+    def get_track_gain(self, track):
+        """volume factor that brings the track down to `LOUDNESS_TARGET`,
+        tracks can't be turned up past the user volume"""
+        loudness = getattr(track, "loudness", None)
+        if not self.normalize or loudness is None:
+            return 1.0
+        return min(1.0, 10 ** ((self.LOUDNESS_TARGET - loudness) / 20))
+
+    def get_upcoming_tracks(self, count, fetch=True):
+        """returns (album, track url) of the `count` tracks after the
+        current one, continuing with the next album. without `fetch`
+        the next album is used only if it's already loaded"""
+        band, album, album_index = self.band, self.album, self.album_index
+        if band is None or album is None:
+            return []
+        first = self.track_index + 1
+        upcoming = [(album, url) for url in album.tracks_urls[first:]]
+        if len(upcoming) < count and album_index + 1 < len(band.albums_urls):
+            album_url = self.bandcamp.to_full_url(
+                band, band.get_album_url(album_index + 1)
+            )
+            if fetch:
+                next_album = self.bandcamp.get_album(album_url)
+            else:
+                next_album = self.bandcamp.get_item(album_url)
+            if next_album is not None:
+                next_album.band = band
+                upcoming += [(next_album, url) for url in next_album.tracks_urls]
+        return upcoming[:count]
+
     def get_media_player(self, path):
+        self.current_sound = self.sound_pool.take(path)
         try:
-            self.current_sound = load_sound(path, streaming=True)
+            if self.current_sound is None:
+                self.current_sound = load_sound(path, streaming=True)
         except FileNotFoundError as e:
             _log("Can't get media player: ", e)
             self.status_text = "Can't play this track"
             raise Exception(self.status_text)
         self.media_player = self.current_sound.play(volume=0)
-        self.media_player.push_handlers(on_eos=self._handler_music_over)
+        self.media_player.push_handlers(on_eos=self.on_eos)
 
-    @task_runner.task
+    @task_runner.task(priority=BackgroundTaskRunner.PRIORITY_USER)
     def pause(self):
-        self.status_text = "Pause"
-        if self.media_player:
-            self.fade_out(0.25)
-            self.media_player.pause()
-            self.continue_playing = False
-            self.status_text = "Paused"
+        with self._state_lock:
+            self.status_text = "Pause"
+            if self.media_player:
+                self.fade_out(0.25, on_done=self.media_player.pause)
+                self.continue_playing = False
+                self.status_text = "Paused"
+            elif self.buffering is not None:
+                # `resume_buffered` leaves it paused
+                self.continue_playing = False
+                self.status_text = "Paused"
 
-    @task_runner.task
+    # at the priority of `play`, so a play queued after it doesn't
+    # start the track it's about to skip
+    @task_runner.task(priority=BackgroundTaskRunner.PRIORITY_USER, supersede=True)
     def next(self):
-        self.status_text = "Next"
-        self.track = None
-        self.fade_out()
-        self.clear_media_player_and_current_sound()
+        with self._state_lock:
+            self.status_text = "Next"
+            self.track = None
+            self.buffering = None
+            self.discard_upcoming()
+            self.clear_media_player_and_current_sound(fade_duration=1.0)
         self.get_next_track()
 
         if self.continue_playing:
@@ -151,7 +838,8 @@ class Player:
             raise EndOfPlaylistException(self.status_text)
         self.album_index = album_index
         album = self.bandcamp.get_album(
-            self.bandcamp.to_full_url(self.band, self.band.get_album_url(album_index))
+            self.bandcamp.to_full_url(self.band, self.band.get_album_url(album_index)),
+            self.task_runner.scope,
         )
         if album is None:
             raise StopCurrentTaskExeption("get next album: cant get album")
@@ -164,83 +852,149 @@ class Player:
         self.get_next_album()
         self.next()
 
-    def stop(self):
-        self.fade_out()
-        self.clear_media_player_and_current_sound()
-        self.continue_playing = False
+    def stop(self, fade_duration=1.0):
+        with self._state_lock:
+            self.buffering = None
+            self.discard_upcoming()
+            self.clear_media_player_and_current_sound(fade_duration=fade_duration)
+            self.continue_playing = False
+
+    def discard_upcoming(self):
+        """the prepared sound goes back to the pool, `next` plays it"""
+        with self._upcoming_lock:
+            upcoming, self.upcoming = self.upcoming, None
+        if upcoming is not None:
+            self.sound_pool.put(
+                self.bandcamp.get_absolute_path(upcoming.track.path), upcoming.sound
+            )
 
-    def clear_media_player_and_current_sound(self):
+    def clear_media_player_and_current_sound(self, fade_duration=0, release=True):
+        """with `fade_duration` the sound keeps playing until it fades
+        out, the player is free to load the next one meanwhile. with
+        `release` a partial file being played is released once stopped"""
+        play_path = self.track_play_path if release else None
+        if play_path is not None and not self.media_player:
+            self.bandcamp.release_partial(play_path)
         if self.current_sound and self.media_player:
-            self.current_sound.stop(self.media_player)
+            sound, media_player = self.current_sound, self.media_player
+
+            def stop_sound():
+                sound.stop(media_player)
+                if play_path is not None:
+                    self.bandcamp.release_partial(play_path)
+
             try:
-                self.media_player.pop_handlers()
+                media_player.pop_handlers()
             except Exception as e:
                 _log("Unable to pop handler", e)
             # in some cases, the GUI called `get_volume` and the
             # `current_sound` attribute did not exist. that's why we
             # set to None before we delete the object.
-            _ = self.current_sound
             self.current_sound = None
-            del _
-            _ = self.media_player
             self.media_player = None
-            del _
+            if fade_duration:
+                self.start_fade(
+                    sound,
+                    media_player,
+                    0.0,
+                    fade_duration,
+                    on_done=stop_sound,
+                )
+            else:
+                self.cancel_fade(media_player)
+                stop_sound()
             self.status_text = "Stopped"
 
+    def start_fade(self, sound, media_player, end, duration, on_done=None, exact=False):
+        """ramp the volume to `end` and return immediately, `duration`
+        is the time to go through the whole volume range, or the time
+        the fade takes with `exact`. a fade already running on the
+        media player is cancelled"""
+        start = sound.get_volume(media_player)
+        if not exact:
+            duration *= abs(end - start)
+        fade = Fade(sound, media_player, start, end, duration, on_done)
+        with self._fades_lock:
+            self.fades[media_player] = fade
+
+    def cancel_fade(self, media_player):
+        with self._fades_lock:
+            self.fades.pop(media_player, None)
+
+    def finish_fades(self):
+        """complete the running fades without waiting for them"""
+        with self._fades_lock:
+            fades = list(self.fades.values())
+            self.fades.clear()
+        for fade in fades:
+            if fade.on_done:
+                fade.on_done()
+
+    def update_fades(self, delta_time):
+        now = time.monotonic()
+        with self._fades_lock:
+            fades = list(self.fades.values())
+        for fade in fades:
+            volume, done = fade.volume(now)
+            try:
+                fade.sound.set_volume(volume, fade.media_player)
+            except AttributeError:
+                pass
+            if not done:
+                continue
+            with self._fades_lock:
+                if self.fades.get(fade.media_player) is not fade:
+                    # replaced meanwhile
+                    continue
+                del self.fades[fade.media_player]
+            if fade.on_done:
+                fade.on_done()
+
     def fade_in(self, duration=1.0):
         if self.media_player and self.current_sound:
-            new_vol = (
-                self.current_sound.get_volume(self.media_player)
-                + Player.VOLUME_DELTA_SMALL
+            self.start_fade(
+                self.current_sound,
+                self.media_player,
+                min(1.0, self.user_volume) * self.gain,
+                duration,
             )
-            for i in range(100):
-                if new_vol > 1:
-                    new_vol = 1
-                if new_vol > self.user_volume:
-                    new_vol = self.user_volume
-                self.volume_set(new_vol, set_user_volume=False)
-                new_vol += Player.VOLUME_DELTA_SMALL
-                time.sleep(duration / 100)
 
     def volume_up(self, value=VOLUME_DELTA):
         if self.media_player:
-            new_vol = self.current_sound.get_volume(self.media_player) + value
+            new_vol = self.current_sound.get_volume(self.media_player) / self.gain
+            new_vol += value
             if new_vol > 1.0:
                 new_vol = 1
             self.volume_set(new_vol)
 
     def volume_down(self, value=VOLUME_DELTA):
         if self.media_player:
-            new_vol = self.current_sound.get_volume(self.media_player) - value
+            new_vol = self.current_sound.get_volume(self.media_player) / self.gain
+            new_vol -= value
             if new_vol < 0.0:
                 new_vol = 0.0
             self.volume_set(new_vol)
 
     def volume_set(self, value, set_user_volume=True):
         if self.media_player:
+            if set_user_volume:
+                self.cancel_fade(self.media_player)
             try:
-                self.current_sound.set_volume(value, self.media_player)
+                self.current_sound.set_volume(value * self.gain, self.media_player)
             except AttributeError:
                 pass
             if set_user_volume:
                 self.user_volume = value
 
-    def fade_out(self, duration=1.0):
-        if self.media_player:
-            new_vol = (
-                self.current_sound.get_volume(self.media_player)
-                - Player.VOLUME_DELTA_SMALL
+    def fade_out(self, duration=1.0, on_done=None):
+        if self.media_player and self.current_sound:
+            self.start_fade(
+                self.current_sound, self.media_player, 0.0, duration, on_done
             )
-            for volume in range(100):
-                if new_vol < 0.0:
-                    new_vol = 0.0
-                self.volume_set(new_vol, set_user_volume=False)
-                new_vol -= Player.VOLUME_DELTA_SMALL
-                time.sleep(duration / 100)
 
     def get_volume(self):
         if self.current_sound and self.media_player and self.media_player.playing:
-            return self.current_sound.get_volume(self.media_player)
+            return self.current_sound.get_volume(self.media_player) / self.gain
         return 0.5
 
     def get_position(self):
@@ -271,8 +1025,17 @@ class Player:
         return ""
 
     def quit(self):
-        self.task_runner.running = False
-        self.stop()
+        self.task_runner.stop()
+        self.prefetch_runner.stop()
+        # nothing updates fades from now on, sounds are stopped at once
+        self.stop(fade_duration=0)
+        self.finish_fades()
+        unschedule(self.update_fades)
+        unschedule(self.update_transition)
+        unschedule(self.update_buffering)
+        self.sound_pool.clear()
+        self.bandcamp.storage.flush()
+        self.bandcamp.tracks_index.storage.flush()
 
     def info(self):
         d = {
@@ -283,9 +1046,21 @@ class Player:
             "duration": self.get_duration(),
             "error": self.error,
             "status": str(self.status_text),
+            "download": self.get_download_progress(),
         }
         return d
 
+    def get_download_progress(self):
+        progress = self.bandcamp.download_progress(self.downloading_path)
+        if progress is None:
+            if self.download_error is not None:
+                return f"download failed: {self.download_error}"
+            return ""
+        done, total = progress
+        if total:
+            return f"downloading {done * 100 // total}%"
+        return f"downloading {done // 1024} KiB"
+
     def statistics(self):
         r = ""
         if self.band:
@@ -316,8 +1091,9 @@ class Player:
 
     @property
     def volume_min(self):
-        return self.get_volume() == 0.0
+        return math.isclose(self.get_volume(), 0.0, abs_tol=1e-6)
 
     @property
     def volume_max(self):
-        return self.get_volume() == 1.0
+        # the volume is divided by the track gain
+        return math.isclose(self.get_volume(), 1.0)
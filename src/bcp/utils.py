@@ -1,14 +1,24 @@
+import asyncio
+import atexit
+import email.utils
+import functools
+import heapq
+import http.client
+import itertools
 import json
 import os
 import random
+import sqlite3
 import ssl
 import tempfile
 import threading
 import time
-import urllib.request
+import urllib.parse
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timezone
 from pathlib import Path
+from urllib.error import HTTPError, URLError
 from tkinter import Tk
 
 from fake_useragent import UserAgent
@@ -22,8 +32,28 @@ os.environ["ALSOFT_LOGLEVEL"] = "0"
 DEBUG = os.environ.get("DEBUG", False)
 _log = get_loger(__name__)
 
-THROTTLE_TIME = (5, 15)
-_prev_call_time = datetime(year=2000, month=1, day=1)
+# host: (requests per second, burst, max seconds of random jitter).
+# matched by domain suffix, "" applies to any other host. pages are
+# requested politely, the mp3 cdn doesn't need the same treatment.
+RATE_LIMITS = {
+    "bandcamp.com": (1 / 8, 1, 4),
+    "bcbits.com": (1, 4, 0),
+    "": (1 / 8, 1, 4),
+}
+# requests that can be in flight at the same time
+HTTP_WORKERS = 4
+# keep-alive connections kept open per host and for how long
+HTTP_MAX_IDLE_CONNECTIONS = 2
+HTTP_IDLE_TIMEOUT = 60
+# If a timeout is not set, it waits too long
+HTTP_TIMEOUT = 30
+# user agents to pick from and seconds before picking new ones, None
+# keeps them for the whole session
+USER_AGENT_POOL_SIZE = 4
+USER_AGENT_ROTATE_SECONDS = None
+# http cache bounds, entries are evicted least recently used first
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 50 * 1024 * 1024))
+CACHE_MAX_AGE_HOURS = int(os.environ.get("CACHE_MAX_AGE_HOURS", 24 * 7))
 
 NAME = "patricie"
 if DEBUG:
@@ -34,11 +64,13 @@ if not USER_DATA_DIR.exists():
     USER_DATA_DIR.mkdir(parents=True, exist_ok=True)
 _log("user data path:", USER_DATA_DIR)
 
-CACHE_PATH = USER_DATA_DIR / "http_cache.json"
+CACHE_PATH = USER_DATA_DIR / "http_cache.sqlite3"
 _log("cache path:", CACHE_PATH)
 
 STORAGE_PATH = USER_DATA_DIR / "storage.json"
 _log("storage path:", STORAGE_PATH)
+# seconds to wait before writing pending storage changes
+STORAGE_FLUSH_DELAY = 5
 
 
 def get_clipboad_content():
@@ -49,16 +81,121 @@ def get_clipboad_content():
     return t
 
 
-def throttle():
-    if DEBUG:
-        return
-    global _prev_call_time
-    _time_diff = (datetime.now() - _prev_call_time).total_seconds()
-    _throttle_for = random.randint(*THROTTLE_TIME) - _time_diff
-    if _throttle_for >= 0:
-        _log("Throttle start: {:.2f}".format(_throttle_for))
-        time.sleep(_throttle_for)
-    _prev_call_time = datetime.now()
+class TokenBucket:
+    """Allows `burst` requests at once and refills at `rate` tokens per
+    second. A caller takes a token even if there's none available and
+    is told how long to wait for it, so concurrent callers queue up
+    instead of racing for the next token.
+
+    """
+
+    def __init__(self, rate, burst=1, jitter=0):
+        self.rate = rate
+        self.burst = burst
+        self.jitter = jitter
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """take a token and return the seconds to wait before using it"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        return delay + random.uniform(0, self.jitter)
+
+
+class RateLimiter:
+    """Keeps a `TokenBucket` per host, configured by the longest
+    matching domain suffix in `limits`."""
+
+    def __init__(self, limits=None):
+        self.limits = RATE_LIMITS if limits is None else limits
+        self.buckets = dict()
+        self._lock = threading.Lock()
+
+    def get_bucket(self, host):
+        with self._lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                suffix = max(
+                    (k for k in self.limits if host == k or host.endswith("." + k)),
+                    key=len,
+                    default="",
+                )
+                bucket = TokenBucket(*self.limits[suffix])
+                self.buckets[host] = bucket
+        return bucket
+
+    def reserve(self, url):
+        """take a token for the host of `url` and return the seconds to
+        wait before requesting it"""
+        if DEBUG:
+            return 0
+        host = urllib.parse.urlparse(url).hostname or ""
+        throttle_for = self.get_bucket(host).reserve()
+        if throttle_for > 0:
+            _log("Throttle start {}: {:.2f}".format(host, throttle_for))
+        return throttle_for
+
+    def wait(self, url):
+        throttle_for = self.reserve(url)
+        if throttle_for > 0:
+            time.sleep(throttle_for)
+
+    async def wait_async(self, url):
+        """same as `wait` without blocking the event loop. if the task
+        is cancelled while waiting the token is lost"""
+        throttle_for = self.reserve(url)
+        if throttle_for > 0:
+            await asyncio.sleep(throttle_for)
+
+
+class RetryPolicy:
+    """How many times and how long to wait before retrying a request.
+    The wait grows exponentially from `backoff` up to `max_backoff`
+    with up to `jitter` of it added at random. A `Retry-After` sent by
+    the server is used instead when present, limited to
+    `max_retry_after`.
+
+    """
+
+    def __init__(
+        self, retries=3, backoff=1, max_backoff=30, jitter=0.5, max_retry_after=300
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.max_retry_after = max_retry_after
+
+    def delay(self, attempt, retry_after=None):
+        """seconds to wait after the failed `attempt`, starting at 1"""
+        seconds = self.parse_retry_after(retry_after)
+        if seconds is not None:
+            return min(seconds, self.max_retry_after)
+        seconds = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return seconds + random.uniform(0, seconds * self.jitter)
+
+    @classmethod
+    def parse_retry_after(cls, value):
+        """`Retry-After` is either seconds or an http date"""
+        if not value:
+            return None
+        try:
+            return max(0, int(value))
+        except ValueError:
+            pass
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0, (date - datetime.now(timezone.utc)).total_seconds())
 
 
 class CacheableResponse:
@@ -74,17 +211,25 @@ class CacheableResponse:
         self._original_url = None
         self._returned_url = None
         self._content = None
+        self._etag = None
+        self._last_modified = None
+        # set when the server answered 304 to a conditional request
+        self.not_modified = False
 
     def from_response(self, url, response):
         self._original_url = url
         self._returned_url = response.geturl()
         self._content = response.read().decode("utf-8")
+        self._etag = response.headers.get("ETag")
+        self._last_modified = response.headers.get("Last-Modified")
         return self
 
     def from_cache(self, entry):
         self._original_url = entry["original_url"]
         self._returned_url = entry["returned_url"]
         self._content = entry["content"]
+        self._etag = entry.get("etag")
+        self._last_modified = entry.get("last_modified")
         return self
 
     def serialize(self):
@@ -92,8 +237,20 @@ class CacheableResponse:
             "original_url": self._original_url,
             "returned_url": self._returned_url,
             "content": self._content,
+            "etag": self._etag,
+            "last_modified": self._last_modified,
         }
 
+    @property
+    def validators(self):
+        """headers to make a conditional request for this response"""
+        headers = dict()
+        if self._etag:
+            headers["If-None-Match"] = self._etag
+        if self._last_modified:
+            headers["If-Modified-Since"] = self._last_modified
+        return headers
+
     def geturl(self):
         return self._returned_url
 
@@ -107,123 +264,678 @@ class CacheableResponse:
         pass
 
 
+class PooledResponse:
+    """Wraps `http.client.HTTPResponse` with the parts of the urllib
+    response interface we use. The connection goes back to the pool
+    once the body was read completely, otherwise it's closed."""
+
+    def __init__(self, pool, key, connection, response, url):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._url = url
+        self.headers = response.headers
+        self.status = self.code = response.status
+
+    def geturl(self):
+        return self._url
+
+    def read(self, amt=None):
+        content = self._response.read(amt)
+        if self._response.isclosed():
+            self.release()
+        return content
+
+    def read1(self, amt=-1):
+        """read what's available, up to `amt` bytes"""
+        content = self._response.read1(amt)
+        if self._response.isclosed():
+            self.release()
+        return content
+
+    def release(self):
+        if self._connection is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.put(self._key, self._connection)
+        else:
+            self._connection.close()
+        self._connection = None
+
+    def close(self):
+        self.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class ConnectionPool:
+    """Keeps up to `max_idle` keep-alive connections per host for
+    `idle_timeout` seconds. All https connections share one SSL
+    context, created on first use, so the CA bundle is loaded once.
+
+    Redirects are followed and error statuses raise `HTTPError`,
+    connection problems raise `URLError`, like `urlopen` does.
+
+    """
+
+    MAX_REDIRECTS = 10
+
+    def __init__(
+        self,
+        cafile,
+        max_idle=HTTP_MAX_IDLE_CONNECTIONS,
+        idle_timeout=HTTP_IDLE_TIMEOUT,
+        timeout=HTTP_TIMEOUT,
+    ):
+        self.cafile = cafile
+        self._context = None
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        # (scheme, host, port): [(connection, released at), ...]
+        self.idle = dict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            connections = self.idle.get(key, [])
+            while connections:
+                connection, released = connections.pop()
+                if now - released < self.idle_timeout:
+                    return connection, True
+                connection.close()
+        scheme, host, port = key
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(
+                host, port, timeout=self.timeout, context=self.context
+            )
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return connection, False
+
+    @property
+    def context(self):
+        with self._lock:
+            if self._context is None:
+                self._context = ssl.create_default_context(cafile=self.cafile)
+        return self._context
+
+    def put(self, key, connection):
+        with self._lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append((connection, time.monotonic()))
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            for connections in self.idle.values():
+                for connection, _ in connections:
+                    connection.close()
+            self.idle.clear()
+
+    def request(self, url, headers=None):
+        for _ in range(self.MAX_REDIRECTS):
+            response = self._request(url, headers or dict())
+            location = response.headers.get("Location")
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                response.release()
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if response.status >= 400:
+                response.release()
+                raise HTTPError(
+                    url,
+                    response.status,
+                    response._response.reason,
+                    response.headers,
+                    response._response,
+                )
+            return response
+        raise URLError(f"too many redirects {url}")
+
+    def _request(self, url, headers):
+        parsed_url = urllib.parse.urlsplit(url)
+        key = (parsed_url.scheme, parsed_url.hostname, parsed_url.port)
+        path = parsed_url.path or "/"
+        if parsed_url.query:
+            path += "?" + parsed_url.query
+        connection, reused = self.get(key)
+        try:
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                connection.close()
+                if not reused:
+                    raise
+                # the server closed the idle connection, use a new one
+                _log(f"    connection to {parsed_url.hostname} was closed")
+                connection, reused = self.get_new(key)
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+        except TimeoutError:
+            connection.close()
+            raise
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            raise URLError(e)
+        return PooledResponse(self, key, connection, response, url)
+
+    def get_new(self, key):
+        with self._lock:
+            for connection, _ in self.idle.pop(key, []):
+                connection.close()
+        return self.get(key)
+
+
+class UserAgentProvider:
+    """Picks `pool_size` desktop user agents once and gives each host
+    the same one for the lifetime of the session, or until the pool
+    is rotated every `rotate_seconds`.
+
+    """
+
+    def __init__(
+        self, pool_size=USER_AGENT_POOL_SIZE, rotate_seconds=USER_AGENT_ROTATE_SECONDS
+    ):
+        self.pool_size = pool_size
+        self.rotate_seconds = rotate_seconds
+        self.pool = list()
+        self.by_host = dict()
+        self.rotated = None
+        self._lock = threading.Lock()
+
+    def rotate(self):
+        ua = UserAgent(platforms=["desktop"])
+        self.pool = [ua.random for _ in range(self.pool_size)]
+        self.by_host.clear()
+        self.rotated = time.monotonic()
+        _log(f"user agents rotated {len(self.pool)}")
+
+    def get(self, host):
+        with self._lock:
+            if not self.pool or (
+                self.rotate_seconds is not None
+                and time.monotonic() - self.rotated > self.rotate_seconds
+            ):
+                self.rotate()
+            user_agent = self.by_host.get(host)
+            if user_agent is None:
+                user_agent = self.by_host[host] = random.choice(self.pool)
+        return user_agent
+
+
 class HTTPSession:
     """I'm not using `requests` library because i get 403. i tried
     setting 'User-Agent' and other headers but it doesn't work.
 
+    Connections are reused through a `ConnectionPool`.
+
     """
 
-    def __init__(self):
+    def __init__(self, rate_limiter=None, workers=HTTP_WORKERS, user_agents=None):
         self.cache = HTTPChache(CACHE_PATH)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.user_agents = user_agents or UserAgentProvider()
+        self.pool = ConnectionPool(cafile="certifi/cacert.pem")
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="http"
+        )
+
+    async def throttle_async(self, url):
+        await self.rate_limiter.wait_async(url)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """await `func` running in the worker pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs)
+        )
 
-    def get(self, url):
+    def get(
+        self, url, expire_hours=None, revalidate=False, throttle=True, headers=None
+    ):
+        """returns the cached response for `url` or requests it. with
+        `revalidate` the cache is skipped. if there's a cached response,
+        even an expired one, the request is conditional and a 304 from
+        the server returns the cached response with `not_modified` set.
+        `throttle=False` is for callers that already waited for the rate
+        limiter, ie: with `throttle_async`. `headers` are added to the
+        request.
+
+        """
         _log(f"http session get: {url}")
-        response = self.cache.get(url)
+        response = None if revalidate else self.cache.get(url)
         if not response:
-            throttle()
-            request = urllib.request.Request(url)
+            stale = self.cache.get(url, stale=True)
+            if throttle:
+                self.rate_limiter.wait(url)
             # for some band urls not using a user agent makes bandcamp redirect
-            ua = UserAgent(platforms=["desktop"])
-            request.add_header("User-Agent", ua.random)
-            context = ssl.create_default_context(cafile="certifi/cacert.pem")
-            # If a timeout is not set, it waits too long
-            r = urllib.request.urlopen(request, context=context, timeout=30)
-            response = self.cache.set(url, r)
+            user_agent = self.user_agents.get(urllib.parse.urlparse(url).hostname)
+            request_headers = {"User-Agent": user_agent, **(headers or dict())}
+            if stale:
+                request_headers.update(stale.validators)
+            r = self.pool.request(url, request_headers)
+            if stale and r.status == 304:
+                _log("    not modified")
+                r.read()
+                r.release()
+                self.cache.refresh(url, expire_hours=expire_hours)
+                stale.not_modified = True
+                return stale
+            response = self.cache.set(url, r, expire_hours=expire_hours)
         return response
 
 
 class HTTPChache:
-    def __init__(self, path):
+    """Keyed on-disk store for `CacheableResponse` entries.
+
+    Entries live in a sqlite database with one row per url, so `get`,
+    `set` and `invalidate` only touch the row they need instead of
+    reading or rewriting every cached page.
+
+    The store is bounded: each entry expires after its own ttl (or
+    `max_age_hours`) and once the content exceeds `max_bytes` the
+    least recently used entries are evicted. Expired entries with an
+    ETag or Last-Modified are kept for another `max_age_hours` so they
+    can be revalidated.
+
+    """
+
+    SCHEMA_VERSION = 3
+    # the json file the whole cache used to be stored in, next to `path`
+    LEGACY_FILENAME = "http_cache.json"
+    COLUMNS = (
+        "original_url",
+        "returned_url",
+        "content",
+        "etag",
+        "last_modified",
+    )
+
+    def __init__(
+        self, path, max_bytes=CACHE_MAX_BYTES, max_age_hours=CACHE_MAX_AGE_HOURS
+    ):
         self.path = Path(path)
-        self.items = dict()
-        self.disabled = False
-        if not self.path.exists():
-            _log("http cache file created")
-            self.path.touch()
-            self._write()
-        else:
-            _log("http cache file exists")
-            try:
-                self._read()
-            except json.decoder.JSONDecodeError as e:
-                _log(f"http cache file overwriten {e}")
-                self._write()
-                self.__init__(path)
+        self.max_bytes = max_bytes
+        self.max_age_hours = max_age_hours
+        # disabling applies to the calling thread only, other threads
+        # keep using the cache
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # the session is created on the main thread and used from the
+        # task runner, access is serialized with `_lock`
+        self._connection = self._connect()
+        try:
+            self._create_table()
+        except sqlite3.DatabaseError as e:
+            _log(f"http cache file overwriten {e}")
+            self._connection.close()
+            self.path.unlink()
+            self._connection = self._connect()
+            self._create_table()
+        self.remove_legacy_cache()
+        self.evict()
+        _log(f"http cache entries {len(self)}")
+
+    def remove_legacy_cache(self):
+        legacy_path = self.path.with_name(self.LEGACY_FILENAME)
+        try:
+            legacy_path.unlink()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            _log(f"http cache can't remove {legacy_path} {e}")
+            return
+        _log(f"http cache removed {legacy_path}")
 
-    def set(self, key, response):
+    def _connect(self):
+        return sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+
+    def _create_table(self):
+        (version,) = self._connection.execute("PRAGMA user_version").fetchone()
+        if version != self.SCHEMA_VERSION:
+            _log(f"http cache schema {version} dropped")
+            self._connection.execute("DROP TABLE IF EXISTS responses")
+            self._connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " original_url TEXT PRIMARY KEY,"
+            " returned_url TEXT,"
+            " content TEXT,"
+            " etag TEXT,"
+            " last_modified TEXT,"
+            " size INTEGER,"
+            " expires REAL,"
+            " accessed REAL"
+            ")"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+        )
+
+    def __len__(self):
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()
+        return count
+
+    @property
+    def size(self):
+        with self._lock:
+            (size,) = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return size
+
+    def _expires(self, expire_hours):
+        if expire_hours is None or expire_hours > self.max_age_hours:
+            expire_hours = self.max_age_hours
+        return time.time() + expire_hours * 3600
+
+    def set(self, key, response, expire_hours=None):
         _log(f"http cache set {key}")
         if self.disabled:
             _log("    disabled")
             return response
         cacheable = CacheableResponse().from_response(key, response)
-        self.items[key] = cacheable.serialize()
-        self._write()
+        entry = cacheable.serialize()
+        size = len(entry["content"].encode("utf-8"))
+        if size > self.max_bytes:
+            _log("    too big")
+            return cacheable
+        with self._lock:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO responses ({', '.join(self.COLUMNS)},"
+                " size, expires, accessed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    *(entry[c] for c in self.COLUMNS),
+                    size,
+                    self._expires(expire_hours),
+                    time.time(),
+                ),
+            )
+        self.evict()
         return cacheable
 
-    def get(self, key):
+    def get(self, key, stale=False):
+        """returns the cached response for `key`. expired entries are
+        only returned with `stale`, ie: to revalidate them"""
         _log(f"http cache get {key}")
         r = None
         if self.disabled:
             return r
-        self._read()
-        value = self.items.get(key)
-        if value:
-            r = CacheableResponse().from_cache(value)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT {', '.join(self.COLUMNS)}, expires FROM responses"
+                " WHERE original_url = ?",
+                (key,),
+            ).fetchone()
+            if row and row[-1] <= now and not stale:
+                _log("    expired")
+                row = None
+            elif row:
+                self._connection.execute(
+                    "UPDATE responses SET accessed = ? WHERE original_url = ?",
+                    (now, key),
+                )
+        if row:
+            r = CacheableResponse().from_cache(dict(zip(self.COLUMNS, row)))
             _log(f"    hit {r.geturl()}")
         return r
 
+    def refresh(self, key, expire_hours=None):
+        """the entry is still valid, ie: the server answered 304"""
+        _log(f"http cache refresh {key}")
+        with self._lock:
+            self._connection.execute(
+                "UPDATE responses SET expires = ?, accessed = ? WHERE original_url = ?",
+                (self._expires(expire_hours), time.time(), key),
+            )
+
     def invalidate(self, url):
         _log(f"http cache invalidate {url}")
-        self._read()
-        if self.items.get(url):
-            del self.items[url]
-            self._write()
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM responses WHERE original_url = ?", (url,)
+            )
 
-    def _write(self):
-        _log("    write")
-        with open(CACHE_PATH, "w") as f:
-            f.write(json.dumps(self.items))
+    def evict(self):
+        """remove expired entries that can't be revalidated, then the
+        least recently used ones until the content fits in `max_bytes`"""
+        now = time.time()
+        with self._lock:
+            expired = self._connection.execute(
+                "DELETE FROM responses WHERE expires <= ? AND"
+                " ((etag IS NULL AND last_modified IS NULL) OR expires <= ?)",
+                (now, now - self.max_age_hours * 3600),
+            ).rowcount
+            (size,) = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            evicted = 0
+            if size > self.max_bytes:
+                rows = self._connection.execute(
+                    "SELECT original_url, size FROM responses ORDER BY accessed"
+                ).fetchall()
+                for url, entry_size in rows:
+                    if size <= self.max_bytes:
+                        break
+                    self._connection.execute(
+                        "DELETE FROM responses WHERE original_url = ?", (url,)
+                    )
+                    size -= entry_size
+                    evicted += 1
+        if expired or evicted:
+            _log(f"    evicted expired: {expired} lru: {evicted}")
 
-    def _read(self):
-        with open(CACHE_PATH, "r") as f:
-            self.items = json.loads(f.read())
-        _log(f"    read {len(self.items)}")
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    @property
+    def disabled(self):
+        return getattr(self._local, "disabled", False)
 
     @contextmanager
     def disable(self):
         try:
-            self.disabled = True
+            self._local.disabled = True
             yield
         finally:
-            self.disabled = False
+            self._local.disabled = False
+
+
+class CancelScope:
+    """Cancels the work of a task from another thread. futures added to
+    the scope are cancelled and `sleep` returns early"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+    def add(self, future):
+        with self._lock:
+            if not self._event.is_set():
+                self._futures.add(future)
+                future.add_done_callback(self._futures.discard)
+                return future
+        future.cancel()
+        return future
+
+    def sleep(self, seconds):
+        """returns True if cancelled before `seconds` passed"""
+        return self._event.wait(seconds)
+
+
+class AsyncRunner(threading.Thread):
+    """Runs an asyncio event loop in its own thread, so coroutines can
+    be used from the rest of the code that is synchronous."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """schedule `coroutine` and return a `concurrent.futures.Future`
+        that can be cancelled"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run_sync(self, coroutine, scope=None):
+        """wait for the result of `coroutine`, must not be called from
+        the loop's thread. if `scope` is cancelled the coroutine is
+        cancelled and `StopCurrentTaskExeption` raised"""
+        future = self.submit(coroutine)
+        if scope is not None:
+            scope.add(future)
+        try:
+            return future.result()
+        except CancelledError:
+            raise StopCurrentTaskExeption("cancelled")
+
+    def gather(self, *coroutines, scope=None):
+        """run the coroutines concurrently and wait for all of them,
+        exceptions are returned as results instead of raised"""
+
+        async def gather():
+            return await asyncio.gather(*coroutines, return_exceptions=True)
+
+        return self.run_sync(gather(), scope)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
 
 class BackgroundTaskRunner(threading.Thread):
+    """Runs tasks one at a time in its own thread.
+
+    Pending tasks are kept in a priority queue, lower values run
+    first and tasks with the same priority run in the order they were
+    queued. The thread sleeps on a condition variable while there's
+    nothing to do.
+
+    A task declared with `supersede=True` removes its pending calls
+    when it's queued again, ie: only the last `next` is run when the
+    user presses next several times while a track is loading. If the
+    task is running, its `scope` is cancelled, the running task passes
+    it to the requests it waits for.
+
+    """
+
+    PRIORITY_USER = 0
+    PRIORITY_DEFAULT = 10
+    PRIORITY_BACKGROUND = 20
+
     def __init__(self):
-        super().__init__()
+        super().__init__(daemon=True)
         self.running = True
         self.working = False
         self.tasks = list()
         self.error = False
+        self._condition = threading.Condition()
+        self._counter = itertools.count()
+        # the running task and the `CancelScope` it can pass along
+        self._running = None
+        self.scope = CancelScope()
 
     def run(self):
-        while self.running:
-            if not self.working:
-                self.do_task()
-            time.sleep(0.01)
+        while True:
+            with self._condition:
+                while self.running and not self.tasks:
+                    self._condition.wait()
+                if not self.running:
+                    return
+            self.do_task()
+
+    def stop(self):
+        with self._condition:
+            self.running = False
+            self.tasks.clear()
+            self._condition.notify_all()
+
+    def task(self, func=None, priority=PRIORITY_DEFAULT, supersede=False):
+        if func is None:
+            return functools.partial(self.task, priority=priority, supersede=supersede)
 
-    def task(self, func):
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
             self.error = False
-            self.tasks.insert(0, (func, args))
+            self.add_task(func, args, priority, supersede)
 
         return wrapper
 
+    def add_task(self, func, args, priority=PRIORITY_DEFAULT, supersede=False):
+        with self._condition:
+            if supersede:
+                self.cancel(func)
+                if func is self._running:
+                    _log(f"running task cancelled: {func.__name__}")
+                    self.scope.cancel()
+            heapq.heappush(self.tasks, (priority, next(self._counter), func, args))
+            self._condition.notify()
+
+    def every(self, seconds, func, *args, priority=PRIORITY_BACKGROUND):
+        """queue `func` every `seconds` while the runner is running. a
+        call still pending when the next one is due is replaced"""
+
+        def schedule():
+            if not self.running:
+                return
+            self.add_task(func, args, priority, supersede=True)
+            start()
+
+        def start():
+            timer = threading.Timer(seconds, schedule)
+            timer.daemon = True
+            timer.start()
+
+        start()
+
+    def cancel(self, func):
+        """remove the pending calls to `func`"""
+        with self._condition:
+            pending = [t for t in self.tasks if t[2] is not func]
+            if len(pending) != len(self.tasks):
+                _log(f"tasks cancelled: {len(self.tasks) - len(pending)}")
+                self.tasks[:] = pending
+                heapq.heapify(self.tasks)
+
     def do_task(self):
-        if not self.tasks:
-            return
-        task_to_run, task_to_run_args = self.tasks.pop()
-        self.working = True
+        with self._condition:
+            if not self.tasks:
+                self.working = False
+                return
+            _, _, task_to_run, task_to_run_args = heapq.heappop(self.tasks)
+            self.working = True
+            self._running = task_to_run
+            self.scope = CancelScope()
         try:
             task_to_run(*task_to_run_args)
         except StopCurrentTaskExeption as e:
@@ -232,7 +944,10 @@ class BackgroundTaskRunner(threading.Thread):
         #     _log("EXCEPTION CATCHED BY RUNNER", e)
         #     self.error = True
         #     self.tasks.clear()
-        self.working = False
+        finally:
+            with self._condition:
+                self._running = None
+            self.working = False
 
 
 class Storage:
@@ -243,38 +958,118 @@ class Storage:
 
     - Serialize to json and deserialize to a dict the information.
 
+    - With `write_behind` (the default) `update` only marks the
+    content dirty, consecutive updates are coalesced and written
+    together after `flush_delay` seconds or when `flush` is called.
+    Pending changes are flushed at exit, however the window is
+    closed.
+
+    Writes go to a temporary file that is renamed over the storage
+    file, so a crash while writing leaves the previous content intact.
+
+    The content in memory is authoritative, the file is read again
+    only by `reload` or when its mtime or size changed since we last
+    read or wrote it.
+
     """
 
-    def __init__(self, serializer):
-        self.path = STORAGE_PATH
+    def __init__(
+        self,
+        serializer,
+        write_behind=True,
+        flush_delay=STORAGE_FLUSH_DELAY,
+        path=STORAGE_PATH,
+    ):
+        self.path = path
         self.serializer = serializer
+        self.write_behind = write_behind
+        self.flush_delay = flush_delay
+        self.dirty = False
+        self._lock = threading.RLock()
+        self._timer = None
+        self._stat = None
         self.content_as_dict = dict()
         if not self.path.exists():
-            self.path.touch()
-            self.write()
-        self.content_as_dict = dict()
-        try:
-            self.content_as_dict = self.read()
-        except json.decoder.JSONDecodeError as e:
-            _log(f"storage corrupted {e}")
             self.write()
+        self.reload()
+        # the flush timer is a daemon thread, it doesn't run at exit
+        atexit.register(self.flush)
+
+    def reload(self):
+        with self._lock:
+            try:
+                self.content_as_dict = self.read()
+            except json.decoder.JSONDecodeError as e:
+                _log(f"storage corrupted {e}")
+                self.content_as_dict = dict()
+                self.write()
+            except FileNotFoundError:
+                _log("storage file removed")
+                self.content_as_dict = dict()
+                self.write()
 
     def read(self):
         with open(self.path, "r") as f:
-            return json.load(f)
+            content = json.load(f)
+        self._stat = self._get_stat()
+        return content
+
+    def _get_stat(self):
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    @property
+    def changed_on_disk(self):
+        return self._get_stat() != self._stat
 
     def write(self):
-        with open(self.path, "w") as f:
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
             json.dump(self.content_as_dict, f, default=self.serializer)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._stat = self._get_stat()
 
     def update(self, items):
-        self.content_as_dict = items
-        self.write()
+        with self._lock:
+            self.content_as_dict = items
+            self.dirty = True
+            if not self.write_behind:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.flush_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self.dirty:
+                return
+            try:
+                self.write()
+            except RuntimeError as e:
+                # items changed while being serialized, try again later
+                _log(f"storage flush postponed {e}")
+                self.update(self.content_as_dict)
+                return
+            self.dirty = False
+            _log("storage flushed")
 
     @property
     def as_dict(self):
-        self.content_as_dict = self.read()
-        return self.content_as_dict
+        with self._lock:
+            # pending changes take precedence over the file
+            if not self.dirty and self.changed_on_disk:
+                _log("storage changed on disk")
+                self.reload()
+            return self.content_as_dict
 
 
 class StopCurrentTaskExeption(Exception):
@@ -3,4 +3,4 @@ import sys
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
 
-from bcp import bandcamp, gui, log, utils  # noqa: F401, E402
+from bcp import bandcamp, gui, log, loudness, player, utils  # noqa: F401, E402
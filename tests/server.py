@@ -0,0 +1,70 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.path, self.headers))
+        route = self.server.routes.get(self.path)
+        if route is None:
+            self.reply(404)
+        else:
+            route(self)
+
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        headers = {"Content-Length": str(len(body)), **(headers or dict())}
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServer:
+    """http server on a free local port running in a thread. `routes`
+    maps paths to functions that get the request handler and answer
+    with `Handler.reply`"""
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.server.routes = dict()
+        self.server.requests = list()
+        self.server.connections = 0
+        self.server.lock = threading.Lock()
+        # checks every 10 ms if `stop` was called
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.01,), daemon=True
+        )
+        self.thread.start()
+
+    @property
+    def routes(self):
+        return self.server.routes
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    @property
+    def connections(self):
+        return self.server.connections
+
+    def url(self, path):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}{path}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
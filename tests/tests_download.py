@@ -0,0 +1,101 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from .context import bandcamp, utils
+from .server import LocalServer
+
+main = bandcamp.main
+
+MP3 = bytes(range(256)) * 16
+
+
+def interrupted(after):
+    """sends the headers of the whole mp3 and closes the connection
+    after `after` bytes of the body, or the rest of the requested range"""
+
+    def reply(handler):
+        byte_range = handler.headers.get("Range")
+        if byte_range is None:
+            handler.send_response(200)
+            handler.send_header("Content-Length", str(len(MP3)))
+            handler.end_headers()
+            handler.wfile.write(MP3[:after])
+            handler.close_connection = True
+            return
+        first = int(byte_range.removeprefix("bytes=").split("-")[0])
+        handler.reply(
+            206,
+            MP3[first:],
+            {"Content-Range": f"bytes {first}-{len(MP3) - 1}/{len(MP3)}"},
+        )
+
+    return reply
+
+
+class ResumeDownloadTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        root = Path(directory.name)
+        self.server = LocalServer()
+        self.addCleanup(self.server.stop)
+        session = main.http_session
+        for patch in (
+            mock.patch.object(main, "TRACKS_DIR", root / "tracks"),
+            mock.patch.object(main, "PARTIAL_DIR", root / "partial"),
+            mock.patch.object(
+                session, "rate_limiter", utils.RateLimiter({"": (1000, 1000, 0)})
+            ),
+            mock.patch.object(session.user_agents, "get", return_value="agent"),
+            mock.patch.dict(
+                main.BandCamp.RETRY_POLICIES,
+                {"mp3": utils.RetryPolicy(retries=2, backoff=0, jitter=0)},
+            ),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.path = root / "tracks" / "band" / "album" / "track.mp3"
+        self.path.parent.mkdir(parents=True)
+
+    def fetch(self):
+        with main.http_session.cache.disable():
+            content, _ = main.BandCamp.fetch_content(
+                self.server.url("/track.mp3"), path=self.path, retry="mp3"
+            )
+        return content
+
+    def test_resume_after_connection_dropped(self):
+        self.server.routes["/track.mp3"] = interrupted(1000)
+        self.assertEqual(self.fetch(), self.path)
+        self.assertEqual(self.path.read_bytes(), MP3)
+        (_, first), (_, second) = self.server.requests
+        self.assertIsNone(first.get("Range"))
+        self.assertEqual(second.get("Range"), "bytes=1000-")
+        self.assertFalse(main.BandCamp.get_partial_path(self.path).exists())
+
+    def test_resume_in_a_later_download(self):
+        self.server.routes["/track.mp3"] = interrupted(1000)
+        with mock.patch.dict(
+            main.BandCamp.RETRY_POLICIES, {"mp3": utils.RetryPolicy(retries=1)}
+        ):
+            self.assertIsNone(self.fetch())
+        self.assertFalse(self.path.exists())
+        self.assertEqual(main.BandCamp.get_partial_offset(self.path), 1000)
+        self.assertEqual(self.fetch(), self.path)
+        self.assertEqual(self.path.read_bytes(), MP3)
+
+    def test_range_ignored(self):
+        partial_path = main.BandCamp.get_partial_path(self.path)
+        partial_path.parent.mkdir(parents=True)
+        partial_path.write_bytes(b"x" * 1000)
+        main.BandCamp.get_partial_length_path(self.path).write_text(
+            f'{{"total": {len(MP3)}}}'
+        )
+        # the server answers the whole file to the range request
+        self.server.routes["/track.mp3"] = lambda h: h.reply(200, MP3)
+        self.assertEqual(self.fetch(), self.path)
+        self.assertEqual(self.path.read_bytes(), MP3)
+        ((_, headers),) = self.server.requests
+        self.assertEqual(headers.get("Range"), "bytes=1000-")
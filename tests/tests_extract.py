@@ -0,0 +1,104 @@
+import json
+import unittest
+from pathlib import Path
+
+from .context import bandcamp
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+
+def extract(name):
+    html = (FIXTURES_DIR / name).read_bytes()
+    return bandcamp.main.PageExtractor.extract(html)
+
+
+class PageExtractorTests(unittest.TestCase):
+    """the expected values are the ones the BeautifulSoup lookups the
+    extractor replaced returned for the same pages"""
+
+    def test_album_page(self):
+        page = extract("album.html")
+        self.assertEqual(page.name, "Rock & Roll")
+        self.assertEqual(page.meta["og:type"], "album")
+        self.assertEqual(page.tracks_urls, ["/track/first", "/track/second"])
+        self.assertEqual(page.tracks_times, ["01:01", "02:05"])
+        self.assertEqual(page.albums_urls, ["/album/other-album"])
+        data = json.loads(page.tralbum)
+        self.assertEqual(data["artist"], "Some Band")
+        self.assertEqual(len(data["trackinfo"]), 2)
+
+    def test_band_page(self):
+        page = extract("band.html")
+        self.assertEqual(page.meta["og:title"], "Some Band")
+        self.assertEqual(page.meta["og:type"], "band")
+        self.assertEqual(page.meta["og:url"], "https://someband.bandcamp.com")
+        self.assertEqual(page.meta["og:description"], 'Music from "somewhere"')
+        self.assertNotIn("description", page.meta)
+        self.assertEqual(
+            page.albums_urls,
+            [
+                "/album/first-album?action=download",
+                "/album/first-album",
+                "/album/second-album",
+                "/album/first-album",
+            ],
+        )
+        self.assertIsNone(page.tralbum)
+        self.assertIsNone(page.name)
+
+    def test_track_page(self):
+        page = extract("track.html")
+        self.assertEqual(page.meta["og:type"], "song")
+        self.assertEqual(page.name, "First <live>")
+        self.assertEqual(page.tracks_urls, [])
+        data = json.loads(page.tralbum)
+        self.assertEqual(data["trackinfo"][0]["title"], "First <live>")
+
+    def test_empty_page(self):
+        page = bandcamp.main.PageExtractor.extract(None)
+        self.assertEqual(page.meta, dict())
+        self.assertIsNone(page.tralbum)
+        self.assertEqual(page.albums_urls, [])
+
+
+class ItemsFromPageTests(unittest.TestCase):
+    def test_album_tracks_from_tralbum(self):
+        album = bandcamp.main.Album("https://someband.bandcamp.com/album/rock-roll")
+        self.assertTrue(album.update_from_page(extract("album.html")))
+        self.assertEqual(album.name, "Rock & Roll")
+        self.assertEqual(album.duration, "0:03:06")
+        tracks = list(album.tracks)
+        self.assertEqual(
+            [t.url for t in tracks],
+            [
+                "https://someband.bandcamp.com/track/first",
+                "https://someband.bandcamp.com/track/second",
+            ],
+        )
+        self.assertEqual(tracks[0].mp3_url, "https://t4.bcbits.com/stream/first")
+        self.assertIsNone(tracks[1].mp3_url)
+
+    def test_band_albums(self):
+        band = bandcamp.main.Band("https://someband.bandcamp.com")
+        self.assertTrue(band.update_from_page(extract("band.html")))
+        self.assertEqual(band.name, "Some Band")
+        self.assertEqual(len(band.albums_urls), 4)
+
+    def test_track(self):
+        track = bandcamp.main.Track("https://someband.bandcamp.com/track/first")
+        self.assertTrue(track.update_from_page(extract("track.html")))
+        self.assertEqual(track.title, "First <live>")
+        self.assertEqual(track.lyrics, "la la")
+        self.assertEqual(track.duration, 61.5)
+
+    def test_refreshed_track_keeps_local_values(self):
+        url = "https://someband.bandcamp.com/track/first"
+        current = bandcamp.main.Track(url)
+        current.path = "tracks/some-band/rock-roll/first.mp3"
+        current.loudness = -9.5
+        track = bandcamp.main.Track(url)
+        track.update_from_page(extract("track.html"))
+        track.keep_local(current.to_dict())
+        self.assertEqual(track.path, current.path)
+        self.assertEqual(track.loudness, -9.5)
+        self.assertFalse(hasattr(track, "peak"))
@@ -0,0 +1,93 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from .context import bandcamp
+
+
+class TracksIndexTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        # cleanups run last in first out, after the indexes are flushed
+        self.addCleanup(directory.cleanup)
+        root = Path(directory.name)
+        self.tracks_dir = root / "tracks"
+        self.tracks_dir.mkdir()
+        self.index_path = root / "tracks_index.json"
+
+    def make_index(self, max_bytes=1000):
+        index = bandcamp.index.TracksIndex(self.tracks_dir, max_bytes, self.index_path)
+        self.addCleanup(index.storage.flush)
+        return index
+
+    def make_track(self, name, size, index=None, played=None):
+        path = self.tracks_dir / "band" / "album" / f"{name}.mp3"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"0" * size)
+        if index is not None:
+            index.add(path, size)
+            if played is not None:
+                index.entries[index.key(path)]["last_played"] = played
+        return path
+
+    def test_scan(self):
+        a = self.make_track("a", 100)
+        self.make_track("b", 200)
+        (self.tracks_dir / "notes.txt").write_text("not a track")
+        index = self.make_index()
+        self.assertEqual(len(index), 2)
+        self.assertIn(a, index)
+        self.assertEqual(index.size, 300)
+        self.assertEqual(index.get_size(a), 100)
+
+    def test_scan_forgets_removed_files(self):
+        a = self.make_track("a", 100)
+        index = self.make_index()
+        index.storage.flush()
+        a.unlink()
+        index = self.make_index()
+        self.assertNotIn(a, index)
+        self.assertEqual(index.get_size(a), 0)
+
+    def test_evict_least_recently_played(self):
+        index = self.make_index(max_bytes=250)
+        a = self.make_track("a", 100, index, played=3)
+        b = self.make_track("b", 100, index, played=1)
+        c = self.make_track("c", 100, index, played=2)
+        self.assertEqual(index.evict(), [b])
+        self.assertFalse(b.exists())
+        self.assertNotIn(b, index)
+        self.assertTrue(a.exists())
+        self.assertTrue(c.exists())
+        self.assertEqual(index.size, 200)
+
+    def test_evict_keep(self):
+        index = self.make_index(max_bytes=150)
+        a = self.make_track("a", 100, index, played=1)
+        b = self.make_track("b", 100, index, played=2)
+        self.assertEqual(index.evict(keep=[a]), [b])
+        self.assertTrue(a.exists())
+
+    def test_evict_under_limit(self):
+        index = self.make_index(max_bytes=1000)
+        a = self.make_track("a", 100, index)
+        self.assertEqual(index.evict(), [])
+        self.assertTrue(a.exists())
+
+    def test_played(self):
+        index = self.make_index(max_bytes=150)
+        a = self.make_track("a", 100, index, played=1)
+        b = self.make_track("b", 100, index, played=2)
+        index.played(a)
+        self.assertEqual(index.entries[index.key(a)]["play_count"], 1)
+        self.assertEqual(index.evict(), [b])
+
+    def test_persisted(self):
+        index = self.make_index()
+        a = self.make_track("a", 100, index)
+        index.played(a)
+        index.storage.flush()
+        self.assertTrue(os.path.exists(self.index_path))
+        index = self.make_index()
+        self.assertEqual(index.entries[index.key(a)]["play_count"], 1)
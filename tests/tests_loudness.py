@@ -0,0 +1,74 @@
+import math
+import sys
+import unittest
+from array import array
+
+from .context import loudness
+
+RATE = 44100
+CHANNELS = 2
+
+
+def tone(seconds, amplitude, frequency=997):
+    """16 bit little endian stereo samples of a sine, `amplitude` is
+    relative to full scale"""
+    samples = array("h")
+    for i in range(int(seconds * RATE)):
+        value = round(amplitude * 32767 * math.sin(2 * math.pi * frequency * i / RATE))
+        samples.extend((value,) * CHANNELS)
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def measure(data, chunk_size=None):
+    block_bytes = int(RATE * loudness.BLOCK_SECONDS) * 2 * CHANNELS
+    chunk_size = chunk_size or block_bytes
+    view = memoryview(data)
+    chunks = (bytes(view[i:][:chunk_size]) for i in range(0, len(data), chunk_size))
+    return loudness.measure(chunks, CHANNELS, block_bytes)
+
+
+def expected_loudness(amplitude):
+    # mean square of a sine is half its amplitude squared, per channel
+    return -0.691 + 10 * math.log10(CHANNELS * amplitude**2 / 2)
+
+
+class MeasureTests(unittest.TestCase):
+    def test_tone(self):
+        result = measure(tone(3, 0.5))
+        self.assertAlmostEqual(result["loudness"], expected_loudness(0.5), delta=0.1)
+        self.assertAlmostEqual(result["peak"], 20 * math.log10(0.5), delta=0.1)
+
+    def test_louder_tone(self):
+        quiet = measure(tone(3, 0.1))["loudness"]
+        loud = measure(tone(3, 0.5))["loudness"]
+        self.assertAlmostEqual(loud - quiet, 20 * math.log10(5), delta=0.1)
+
+    def test_silence(self):
+        self.assertEqual(measure(bytes(RATE * 4)), {"loudness": None, "peak": None})
+
+    def test_silence_gated(self):
+        result = measure(bytes(RATE * 8) + tone(2, 0.5) + bytes(RATE * 8))
+        self.assertAlmostEqual(result["loudness"], expected_loudness(0.5), delta=0.1)
+
+    def test_quiet_parts_gated(self):
+        # 30 dB under the loud part, below the relative gate
+        result = measure(tone(2, 0.5) + tone(2, 0.5 / 10**1.5))
+        self.assertAlmostEqual(result["loudness"], expected_loudness(0.5), delta=0.2)
+
+    def test_chunk_size(self):
+        data = tone(2, 0.3)
+        self.assertEqual(measure(data), measure(data, chunk_size=1001))
+
+
+class MeasureBlockTests(unittest.TestCase):
+    def test_decimation(self):
+        block = tone(loudness.BLOCK_SECONDS, 0.5)
+        power, peak = loudness.measure_block(block, CHANNELS, decimation=1)
+        decimated_power, _ = loudness.measure_block(block, CHANNELS)
+        self.assertAlmostEqual(decimated_power, power, delta=power * 0.05)
+        self.assertAlmostEqual(peak, 0.5 * 32767, delta=2)
+
+    def test_empty(self):
+        self.assertEqual(loudness.measure_block(b"", CHANNELS), (0.0, 0))
@@ -0,0 +1,123 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from .context import player
+
+
+class FakeSource:
+    def __init__(self):
+        self.deleted = False
+
+    def delete(self):
+        self.deleted = True
+
+
+class FakeSound:
+    def __init__(self, path):
+        self.path = path
+        self.source = FakeSource()
+
+    @property
+    def closed(self):
+        return self.source.deleted
+
+
+def load_sound(path, streaming=False):
+    if Path(path).name == "corrupt.mp3":
+        raise ValueError("can't decode")
+    return FakeSound(path)
+
+
+@mock.patch.object(player, "load_sound", load_sound)
+class SoundPoolTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = Path(directory.name)
+
+    def make_file(self, name, size=100):
+        path = self.root / name
+        path.write_bytes(b"0" * size)
+        return str(path)
+
+    def test_warm_in_order(self):
+        pool = player.SoundPool(max_sounds=2, max_bytes=1000)
+        paths = [self.make_file(name) for name in ("a.mp3", "b.mp3", "c.mp3")]
+        pool.warm(paths)
+        self.assertEqual(list(pool.sounds), paths[:2])
+
+    def test_warm_max_bytes(self):
+        pool = player.SoundPool(max_sounds=3, max_bytes=250)
+        paths = [self.make_file(name) for name in ("a.mp3", "b.mp3", "c.mp3")]
+        pool.warm(paths)
+        self.assertEqual(list(pool.sounds), paths[:2])
+        self.assertEqual(pool.size, 200)
+
+    def test_warm_evicts_and_closes(self):
+        pool = player.SoundPool(max_sounds=2, max_bytes=1000)
+        a, b, c = (self.make_file(name) for name in ("a.mp3", "b.mp3", "c.mp3"))
+        pool.warm([a, b])
+        sound_a = pool.sounds[a][0]
+        pool.warm([b, c])
+        self.assertEqual(list(pool.sounds), [b, c])
+        self.assertTrue(sound_a.closed)
+
+    def test_warm_skip(self):
+        pool = player.SoundPool(max_sounds=2, max_bytes=1000)
+        a, b = self.make_file("a.mp3"), self.make_file("b.mp3")
+        pool.warm([a, b])
+        sound_a = pool.sounds[a][0]
+        pool.warm([a, b], skip=[a])
+        self.assertEqual(list(pool.sounds), [b])
+        self.assertTrue(sound_a.closed)
+
+    def test_warm_missing_and_corrupt(self):
+        pool = player.SoundPool(max_sounds=3, max_bytes=1000)
+        corrupt = self.make_file("corrupt.mp3")
+        a = self.make_file("a.mp3")
+        pool.warm([str(self.root / "missing.mp3"), corrupt, a])
+        self.assertEqual(list(pool.sounds), [a])
+
+    def test_take(self):
+        pool = player.SoundPool(max_sounds=2, max_bytes=1000)
+        a = self.make_file("a.mp3")
+        pool.warm([a])
+        sound = pool.take(a)
+        self.assertFalse(sound.closed)
+        self.assertIsNone(pool.take(a))
+        self.assertEqual(len(pool.sounds), 0)
+
+    def test_put_goes_first_and_keeps_bounds(self):
+        pool = player.SoundPool(max_sounds=2, max_bytes=1000)
+        a, b, c = (self.make_file(name) for name in ("a.mp3", "b.mp3", "c.mp3"))
+        pool.warm([b, c])
+        sound_c = pool.sounds[c][0]
+        pool.put(a, FakeSound(a))
+        self.assertEqual(list(pool.sounds), [a, b])
+        self.assertTrue(sound_c.closed)
+
+    def test_put_too_big(self):
+        pool = player.SoundPool(max_sounds=2, max_bytes=50)
+        a = self.make_file("a.mp3")
+        sound = FakeSound(a)
+        pool.put(a, sound)
+        self.assertEqual(len(pool.sounds), 0)
+        self.assertTrue(sound.closed)
+
+    def test_put_missing_file(self):
+        pool = player.SoundPool(max_sounds=2, max_bytes=1000)
+        sound = FakeSound("missing.mp3")
+        pool.put(str(self.root / "missing.mp3"), sound)
+        self.assertEqual(len(pool.sounds), 0)
+        self.assertTrue(sound.closed)
+
+    def test_clear(self):
+        pool = player.SoundPool(max_sounds=2, max_bytes=1000)
+        a = self.make_file("a.mp3")
+        pool.warm([a])
+        sound = pool.sounds[a][0]
+        pool.clear()
+        self.assertEqual(len(pool.sounds), 0)
+        self.assertTrue(sound.closed)
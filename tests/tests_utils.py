@@ -0,0 +1,572 @@
+import itertools
+import json
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from pathlib import Path
+from unittest import mock
+from urllib.error import HTTPError, URLError
+
+from .context import utils
+from .server import LocalServer
+
+
+class FakeResponse:
+    """what `HTTPChache.set` reads from an http.client response"""
+
+    def __init__(self, url, content, headers=None):
+        self.url = url
+        self.content = content
+        self.headers = headers or dict()
+
+    def geturl(self):
+        return self.url
+
+    def read(self):
+        return self.content.encode("utf-8")
+
+
+class HTTPChacheTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        # cleanups run last in first out, after the caches are closed
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / "http_cache.sqlite3"
+
+    def make_cache(self, **kwargs):
+        cache = utils.HTTPChache(self.path, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def set(self, cache, url, content, **kwargs):
+        response = FakeResponse(url, content, kwargs.pop("headers", None))
+        cache.set(url, response, **kwargs)
+        # entries are ordered by access time
+        time.sleep(0.01)
+
+    def test_get(self):
+        cache = self.make_cache()
+        self.set(cache, "https://a", "content a")
+        self.assertEqual(cache.get("https://a").read(), b"content a")
+        self.assertIsNone(cache.get("https://b"))
+
+    def test_persisted(self):
+        cache = self.make_cache()
+        self.set(cache, "https://a", "content a", headers={"ETag": '"1"'})
+        cache.close()
+        cache = self.make_cache()
+        response = cache.get("https://a")
+        self.assertEqual(response.read(), b"content a")
+        self.assertEqual(response.validators, {"If-None-Match": '"1"'})
+
+    def test_invalidate(self):
+        cache = self.make_cache()
+        self.set(cache, "https://a", "content a")
+        self.set(cache, "https://b", "content b")
+        cache.invalidate("https://a")
+        self.assertIsNone(cache.get("https://a"))
+        self.assertIsNotNone(cache.get("https://b"))
+
+    def test_disable(self):
+        cache = self.make_cache()
+        with cache.disable():
+            self.set(cache, "https://a", "content a")
+        self.assertEqual(len(cache), 0)
+
+    def test_legacy_cache_removed(self):
+        legacy_path = self.path.with_name(utils.HTTPChache.LEGACY_FILENAME)
+        legacy_path.write_text("{}")
+        self.make_cache()
+        self.assertFalse(legacy_path.exists())
+
+    def test_evict_least_recently_used(self):
+        cache = self.make_cache(max_bytes=10)
+        self.set(cache, "https://a", "aaaa")
+        self.set(cache, "https://b", "bbbb")
+        cache.get("https://a")
+        time.sleep(0.01)
+        self.set(cache, "https://c", "cccc")
+        self.assertIsNone(cache.get("https://b"))
+        self.assertIsNotNone(cache.get("https://a"))
+        self.assertIsNotNone(cache.get("https://c"))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, 8)
+
+    def test_too_big_is_not_stored(self):
+        cache = self.make_cache(max_bytes=10)
+        self.set(cache, "https://a", "a" * 11)
+        self.assertEqual(len(cache), 0)
+
+    def test_evict_expired(self):
+        cache = self.make_cache()
+        self.set(cache, "https://a", "aaaa", expire_hours=0)
+        self.set(cache, "https://b", "bbbb", expire_hours=0, headers={"ETag": '"1"'})
+        cache.evict()
+        self.assertEqual(len(cache), 1)
+        # expired entries with validators are only returned to revalidate
+        self.assertIsNone(cache.get("https://b"))
+        response = cache.get("https://b", stale=True)
+        self.assertEqual(response.validators["If-None-Match"], '"1"')
+
+    def test_ttl_limited_to_max_age(self):
+        cache = self.make_cache(max_age_hours=0)
+        self.set(cache, "https://a", "aaaa", expire_hours=24)
+        self.assertIsNone(cache.get("https://a"))
+
+    def test_bounds_applied_on_open(self):
+        cache = self.make_cache()
+        self.set(cache, "https://a", "aaaa")
+        self.set(cache, "https://b", "bbbb")
+        cache.close()
+        cache = self.make_cache(max_bytes=4)
+        self.assertIsNone(cache.get("https://a"))
+        self.assertIsNotNone(cache.get("https://b"))
+
+
+class StorageTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        # cleanups run last in first out, after the storages are flushed
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / "storage.json"
+
+    def make_storage(self, **kwargs):
+        storage = utils.Storage(None, path=self.path, **kwargs)
+        self.addCleanup(storage.flush)
+        return storage
+
+    def read(self):
+        return json.loads(self.path.read_text())
+
+    def test_created_empty(self):
+        self.make_storage()
+        self.assertEqual(self.read(), dict())
+
+    def test_write_behind(self):
+        storage = self.make_storage(flush_delay=60)
+        storage.update({"a": 1})
+        storage.update({"a": 1, "b": 2})
+        self.assertEqual(self.read(), dict())
+        storage.flush()
+        self.assertEqual(self.read(), {"a": 1, "b": 2})
+        self.assertFalse(storage.dirty)
+
+    def test_flushed_after_delay(self):
+        storage = self.make_storage(flush_delay=0.05)
+        storage.update({"a": 1})
+        time.sleep(0.3)
+        self.assertEqual(self.read(), {"a": 1})
+
+    def test_write_through(self):
+        storage = self.make_storage(write_behind=False)
+        storage.update({"a": 1})
+        self.assertEqual(self.read(), {"a": 1})
+
+    def test_failed_write_keeps_file(self):
+        storage = self.make_storage(write_behind=False)
+        storage.update({"a": 1})
+        with self.assertRaises(TypeError):
+            storage.update({"a": object()})
+        self.assertEqual(self.read(), {"a": 1})
+        # don't try again at cleanup
+        storage.dirty = False
+
+    def test_content_kept_in_memory(self):
+        storage = self.make_storage(write_behind=False)
+        storage.update({"a": 1})
+        content = storage.as_dict
+        self.assertIs(storage.as_dict, content)
+
+    def test_reload_when_changed_on_disk(self):
+        storage = self.make_storage(write_behind=False)
+        storage.update({"a": 1})
+        self.path.write_text(json.dumps({"a": 1, "b": 2}))
+        self.assertEqual(storage.as_dict, {"a": 1, "b": 2})
+
+    def test_pending_changes_kept(self):
+        storage = self.make_storage(flush_delay=60)
+        storage.update({"a": 1})
+        self.path.write_text(json.dumps({"b": 2}))
+        self.assertEqual(storage.as_dict, {"a": 1})
+        storage.flush()
+        self.assertEqual(self.read(), {"a": 1})
+
+    def test_reload_missing_file(self):
+        storage = self.make_storage(write_behind=False)
+        storage.update({"a": 1})
+        self.path.unlink()
+        self.assertEqual(storage.as_dict, dict())
+        self.assertEqual(self.read(), dict())
+
+    def test_reload_corrupted_file(self):
+        storage = self.make_storage()
+        self.path.write_text("{")
+        storage.reload()
+        self.assertEqual(storage.as_dict, dict())
+        self.assertEqual(self.read(), dict())
+
+
+class BackgroundTaskRunnerTests(unittest.TestCase):
+    def setUp(self):
+        self.runner = utils.BackgroundTaskRunner()
+        self.done = list()
+
+    def record(self, name):
+        self.done.append(name)
+
+    def run_tasks(self):
+        while self.runner.tasks:
+            self.runner.do_task()
+
+    def test_priority_then_fifo(self):
+        runner = self.runner
+        runner.add_task(self.record, ("background",), runner.PRIORITY_BACKGROUND)
+        runner.add_task(self.record, ("default 1",))
+        runner.add_task(self.record, ("user",), runner.PRIORITY_USER)
+        runner.add_task(self.record, ("default 2",))
+        self.run_tasks()
+        self.assertEqual(self.done, ["user", "default 1", "default 2", "background"])
+
+    def test_task_decorator(self):
+        runner = self.runner
+        user = runner.task(self.record, priority=runner.PRIORITY_USER)
+        default = runner.task(self.record)
+        default("default")
+        user("user")
+        self.run_tasks()
+        self.assertEqual(self.done, ["user", "default"])
+
+    def test_supersede_removes_pending_calls(self):
+        runner = self.runner
+
+        def next_track(name):
+            self.record(name)
+
+        other = runner.task(self.record)
+        task = runner.task(next_track, supersede=True)
+        task("first")
+        other("other")
+        task("second")
+        self.run_tasks()
+        self.assertEqual(self.done, ["other", "second"])
+
+    def test_supersede_cancels_running_task(self):
+        runner = self.runner
+        started = threading.Event()
+
+        def load(name, seconds):
+            started.set()
+            cancelled = runner.scope.sleep(seconds)
+            self.record((name, cancelled))
+
+        task = runner.task(load, supersede=True)
+        runner.start()
+        self.addCleanup(runner.stop)
+        task("first", 10)
+        self.assertTrue(started.wait(5))
+        task("second", 0)
+        deadline = time.monotonic() + 5
+        while len(self.done) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # the next run gets a new scope
+        self.assertEqual(self.done, [("first", True), ("second", False)])
+
+    def test_cancel(self):
+        def task(name):
+            self.record(name)
+
+        self.runner.add_task(task, ("a",))
+        self.runner.add_task(self.record, ("b",))
+        self.runner.cancel(task)
+        self.run_tasks()
+        self.assertEqual(self.done, ["b"])
+
+    def test_stop_current_task(self):
+        def stop():
+            raise utils.StopCurrentTaskExeption("stopped")
+
+        self.runner.add_task(stop, ())
+        self.runner.add_task(self.record, ("after",))
+        self.run_tasks()
+        self.assertEqual(self.done, ["after"])
+        self.assertFalse(self.runner.working)
+
+    def test_stop(self):
+        self.runner.add_task(self.record, ("a",))
+        self.runner.stop()
+        self.assertEqual(self.runner.tasks, [])
+
+
+class CancelScopeTests(unittest.TestCase):
+    def test_sleep(self):
+        scope = utils.CancelScope()
+        self.assertFalse(scope.sleep(0.01))
+        scope.cancel()
+        self.assertTrue(scope.cancelled)
+        self.assertTrue(scope.sleep(10))
+
+    def test_futures_cancelled(self):
+        scope = utils.CancelScope()
+        done = scope.add(Future())
+        done.set_result(None)
+        pending = scope.add(Future())
+        scope.cancel()
+        self.assertTrue(pending.cancelled())
+        self.assertFalse(done.cancelled())
+        self.assertTrue(scope.add(Future()).cancelled())
+
+
+class TokenBucketTests(unittest.TestCase):
+    def test_burst_then_queue(self):
+        bucket = utils.TokenBucket(rate=2, burst=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        # callers without a token wait their turn
+        self.assertAlmostEqual(bucket.reserve(), 0.5, delta=0.01)
+        self.assertAlmostEqual(bucket.reserve(), 1, delta=0.01)
+
+    def test_refill(self):
+        bucket = utils.TokenBucket(rate=1, burst=2)
+        bucket.reserve()
+        bucket.reserve()
+        bucket.updated -= 1
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 1, delta=0.01)
+
+    def test_refill_up_to_burst(self):
+        bucket = utils.TokenBucket(rate=1, burst=2)
+        bucket.updated -= 60
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 1, delta=0.01)
+
+    def test_jitter(self):
+        bucket = utils.TokenBucket(rate=1, burst=1, jitter=2)
+        delay = bucket.reserve()
+        self.assertGreaterEqual(delay, 0)
+        self.assertLessEqual(delay, 2)
+
+
+class RateLimiterTests(unittest.TestCase):
+    def test_bucket_by_domain_suffix(self):
+        limits = {"bandcamp.com": (1, 1, 0), "bcbits.com": (2, 4, 0), "": (3, 1, 0)}
+        limiter = utils.RateLimiter(limits)
+        self.assertEqual(limiter.get_bucket("band.bandcamp.com").rate, 1)
+        self.assertEqual(limiter.get_bucket("bandcamp.com").rate, 1)
+        self.assertEqual(limiter.get_bucket("t4.bcbits.com").burst, 4)
+        self.assertEqual(limiter.get_bucket("notbandcamp.com").rate, 3)
+
+    def test_bucket_per_host(self):
+        limiter = utils.RateLimiter({"": (1, 1, 0)})
+        bucket = limiter.get_bucket("a.bandcamp.com")
+        self.assertIs(limiter.get_bucket("a.bandcamp.com"), bucket)
+        self.assertIsNot(limiter.get_bucket("b.bandcamp.com"), bucket)
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalServer()
+        self.addCleanup(self.server.stop)
+        self.server.routes["/page"] = lambda h: h.reply(200, b"page")
+        self.pool = utils.ConnectionPool(cafile=None)
+        self.addCleanup(self.pool.close)
+
+    def get(self, path, headers=None):
+        with self.pool.request(self.server.url(path), headers) as response:
+            return response.status, response.read()
+
+    def test_connection_reused(self):
+        self.assertEqual(self.get("/page"), (200, b"page"))
+        self.assertEqual(self.get("/page"), (200, b"page"))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_unread_response_closes_connection(self):
+        with self.pool.request(self.server.url("/page")):
+            pass
+        self.get("/page")
+        self.assertEqual(self.server.connections, 2)
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = 0
+        self.get("/page")
+        self.get("/page")
+        self.assertEqual(self.server.connections, 2)
+
+    def test_max_idle(self):
+        self.pool.max_idle = 1
+        first = self.pool.request(self.server.url("/page"))
+        second = self.pool.request(self.server.url("/page"))
+        first.read()
+        second.read()
+        (connections,) = self.pool.idle.values()
+        self.assertEqual(len(connections), 1)
+
+    def test_redirect(self):
+        self.server.routes["/old"] = lambda h: h.reply(
+            301, headers={"Location": "/page"}
+        )
+        with self.pool.request(self.server.url("/old")) as response:
+            self.assertEqual(response.geturl(), self.server.url("/page"))
+            self.assertEqual(response.read(), b"page")
+        self.assertEqual(self.server.connections, 1)
+
+    def test_error_status(self):
+        with self.assertRaises(HTTPError) as cm:
+            self.get("/missing")
+        self.assertEqual(cm.exception.code, 404)
+
+    def test_connection_refused(self):
+        url = self.server.url("/page")
+        self.server.stop()
+        with self.assertRaises(URLError):
+            self.pool.request(url)
+
+
+class FakeUserAgent:
+    """`fake_useragent.UserAgent` giving numbered user agents"""
+
+    created = 0
+
+    def __init__(self, platforms=None):
+        FakeUserAgent.created += 1
+        self.count = itertools.count()
+
+    @property
+    def random(self):
+        return f"agent {next(self.count)}"
+
+
+@mock.patch.object(utils, "UserAgent", FakeUserAgent)
+class UserAgentProviderTests(unittest.TestCase):
+    def setUp(self):
+        FakeUserAgent.created = 0
+
+    def test_generator_created_once(self):
+        provider = utils.UserAgentProvider(pool_size=2)
+        for host in ("a", "b", "c", "a"):
+            provider.get(host)
+        self.assertEqual(FakeUserAgent.created, 1)
+        self.assertEqual(provider.pool, ["agent 0", "agent 1"])
+
+    def test_same_agent_per_host(self):
+        provider = utils.UserAgentProvider(pool_size=4)
+        user_agent = provider.get("a.bandcamp.com")
+        self.assertIn(user_agent, provider.pool)
+        for _ in range(10):
+            self.assertEqual(provider.get("a.bandcamp.com"), user_agent)
+
+    def test_rotate(self):
+        provider = utils.UserAgentProvider(pool_size=1, rotate_seconds=60)
+        self.assertEqual(provider.get("a"), "agent 0")
+        provider.rotated -= 61
+        self.assertEqual(provider.get("a"), "agent 0")
+        self.assertEqual(FakeUserAgent.created, 2)
+
+    def test_no_rotation(self):
+        provider = utils.UserAgentProvider(pool_size=1, rotate_seconds=None)
+        provider.get("a")
+        provider.rotated -= 24 * 3600
+        provider.get("a")
+        self.assertEqual(FakeUserAgent.created, 1)
+
+
+@mock.patch.object(utils, "UserAgent", FakeUserAgent)
+class RevalidationTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.server = LocalServer()
+        self.addCleanup(self.server.stop)
+        self.server.routes["/page"] = self.page
+        self.etag = '"1"'
+        self.content = b"page 1"
+        self.session = utils.HTTPSession(utils.RateLimiter({"": (1000, 1000, 0)}))
+        self.session.cache.close()
+        self.session.cache = utils.HTTPChache(Path(directory.name) / "cache.sqlite3")
+        self.addCleanup(self.session.cache.close)
+        self.addCleanup(self.session.executor.shutdown)
+
+    def page(self, handler):
+        if handler.headers.get("If-None-Match") == self.etag:
+            handler.reply(304, headers={"ETag": self.etag})
+        else:
+            handler.reply(200, self.content, {"ETag": self.etag})
+
+    def get(self, revalidate=True):
+        return self.session.get(self.server.url("/page"), revalidate=revalidate)
+
+    def test_first_request_not_conditional(self):
+        response = self.get()
+        self.assertFalse(response.not_modified)
+        self.assertEqual(response.read(), b"page 1")
+        _, headers = self.server.requests[0]
+        self.assertIsNone(headers.get("If-None-Match"))
+
+    def test_not_modified(self):
+        self.get()
+        response = self.get()
+        self.assertTrue(response.not_modified)
+        self.assertEqual(response.read(), b"page 1")
+        _, headers = self.server.requests[1]
+        self.assertEqual(headers.get("If-None-Match"), '"1"')
+
+    def test_modified(self):
+        self.get()
+        self.etag = '"2"'
+        self.content = b"page 2"
+        response = self.get()
+        self.assertFalse(response.not_modified)
+        self.assertEqual(response.read(), b"page 2")
+        self.assertEqual(self.get().read(), b"page 2")
+        self.assertTrue(self.get().not_modified)
+
+    def test_not_modified_refreshes_entry(self):
+        url = self.server.url("/page")
+        self.session.get(url, expire_hours=0)
+        self.assertIsNone(self.session.cache.get(url))
+        self.session.get(url, expire_hours=1)
+        self.assertEqual(len(self.server.requests), 2)
+        # valid again, served from the cache
+        self.assertEqual(self.get(revalidate=False).read(), b"page 1")
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class RetryPolicyTests(unittest.TestCase):
+    def test_exponential_backoff(self):
+        policy = utils.RetryPolicy(backoff=1, max_backoff=5, jitter=0)
+        self.assertEqual([policy.delay(i) for i in range(1, 6)], [1, 2, 4, 5, 5])
+
+    def test_jitter(self):
+        policy = utils.RetryPolicy(backoff=2, jitter=0.5)
+        for _ in range(20):
+            delay = policy.delay(1)
+            self.assertGreaterEqual(delay, 2)
+            self.assertLessEqual(delay, 3)
+
+    def test_retry_after_seconds(self):
+        policy = utils.RetryPolicy(max_retry_after=60)
+        self.assertEqual(policy.delay(1, "12"), 12)
+        self.assertEqual(policy.delay(1, "600"), 60)
+
+    def test_retry_after_invalid(self):
+        policy = utils.RetryPolicy(backoff=1, jitter=0)
+        self.assertEqual(policy.delay(3, "soon"), 4)
+        self.assertEqual(policy.delay(3, ""), 4)
+
+    def test_parse_retry_after(self):
+        parse = utils.RetryPolicy.parse_retry_after
+        self.assertIsNone(parse(None))
+        self.assertIsNone(parse("soon"))
+        self.assertEqual(parse("30"), 30)
+        self.assertEqual(parse("-5"), 0)
+
+    def test_parse_retry_after_date(self):
+        parse = utils.RetryPolicy.parse_retry_after
+        later = datetime.now(timezone.utc) + timedelta(seconds=120)
+        self.assertAlmostEqual(parse(format_datetime(later, usegmt=True)), 120, delta=2)
+        earlier = datetime.now(timezone.utc) - timedelta(seconds=120)
+        self.assertEqual(parse(format_datetime(earlier, usegmt=True)), 0)